@@ -0,0 +1,276 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import struct
+import tempfile
+import timeit
+import tracemalloc
+
+from replay_anonymizer import ReplayAnonymizer, _decode_date
+
+
+def int4(value) -> bytes:
+    "Packs an int as 4 little-endian bytes."
+    return struct.pack('<I', value)
+
+
+def length_string(text) -> bytes:
+    "Packs a string as its int4 length followed by utf-16le characters."
+    encoded = text.encode('utf-16le')
+    return int4(len(encoded) // 2) + encoded
+
+
+def length_ASCII_string(text) -> bytes:
+    "Packs a string as its int4 length followed by ASCII characters."
+    encoded = text.encode('ascii')
+    return int4(len(encoded)) + encoded
+
+
+def chunk(chunkType, chunkVersion, data, chunkName=b"") -> bytes:
+    "Packs a chunk header followed by its data."
+    return (chunkType.encode('ascii') + int4(chunkVersion) + int4(len(data))
+            + int4(len(chunkName)) + bytes(8) + chunkName + data)
+
+
+def relic_chunky(data) -> bytes:
+    "Packs a 36 byte relicChunky header followed by its chunks."
+    return b"Relic Chunky\r\n\x1a\x00" + int4(3) + int4(1) + int4(36) + bytes(8) + data
+
+
+def chat_message(userName, userId, message) -> bytes:
+    "Packs a chat message as found in the command stream."
+    inner = length_string(userName) + int4(userId) + int4(0) + int4(1) + length_string(message)
+    return int4(len(inner) + 8) + int4(1) + int4(len(inner)) + inner
+
+
+def player_names(players=8, nameLength=12) -> list:
+    "Returns unique player names, none of which contains another."
+    if nameLength < 9:
+        # names of equal length never contain one another, CJK so none is part of the header text
+        return [
+            "".join(chr(0x4e00 + number // 256 ** digit % 256) for digit in range(nameLength))
+            for number in range(players)
+        ]
+    return [
+        ("Gamer{}x".format(number) + "abcdefghijklmnopqrstuvwxyz" * 4)[:max(nameLength, 9)]
+        for number in range(players)
+    ]
+
+
+def build_replay(players=8, nameLength=12, chatMessages=100, mentions=10, size=0,
+                 date="23/10/2008 21:31", seed=0) -> bytes:
+    "Builds a valid synthetic replay with chat messages padded to about size bytes."
+
+    rng = random.Random(seed)
+    names = player_names(players, nameLength)
+
+    header = (int4(8) + b"COH__REC" + date.encode('utf-16le') + b"\x00\x00").ljust(76, b"\x00")
+
+    firstChunky = relic_chunky(chunk("FOLDPOST", 1, chunk("DATASDAT", 1, int4(0))))
+
+    database = (
+        bytes(16) + int4(1) + int4(0) + int4(1) + int4(0) + int4(1) + bytes(5)
+        + length_string("synthetic replay") + bytes(8) + int4(0x603872a3) + bytes(23)
+        + length_ASCII_string("2") + bytes(4) + length_ASCII_string("1") + bytes(8) + int4(2)
+        + length_ASCII_string("COH") + length_ASCII_string("2.602.0")
+        + length_ASCII_string("") + length_ASCII_string("automatch"))
+    playerFolders = b"".join(
+        chunk("FOLDGPLY", 1,
+              chunk("DATAINFO", 6,
+                    length_string(name) + bytes([0, 0, 0, 0, number % 2, 0, 0, 0])
+                    + length_ASCII_string("allies" if number % 2 else "axis") + int4(0) + int4(0))
+              + chunk("DATAPLAS", 1, int4(0)))
+        for number, name in enumerate(names))
+    description = (
+        int4(0) + length_string("2008-10-23") + bytes(12) + length_ASCII_string("RelicCOH")
+        + length_ASCII_string("data:maps/pvp/2p_angoville_farms") + bytes(20)
+        + length_string("Angoville") + int4(0) + length_string("Synthetic map description")
+        + int4(0) + int4(513) + int4(513) + bytes(12))
+    secondChunky = relic_chunky(
+        chunk("FOLDINFO", 1,
+              chunk("DATADATA", 1, int4(0)) + chunk("DATABASE", 11, database) + playerFolders)
+        + chunk("DATASDSC", 2004, description))
+
+    replay = bytearray(header + firstChunky + secondChunky)
+
+    # command stream, random ticks with chat messages spread through it
+    filler = max(size - len(replay), 0) // (chatMessages + 1)
+    for message in range(chatMessages):
+        replay += rng.randbytes(filler)
+        number = rng.randrange(players)
+        text = "gg wp"
+        if message < mentions:
+            text = "well played " + names[rng.randrange(players)]
+        replay += chat_message(names[number], 1000 + number, text)
+    replay += rng.randbytes(max(size - len(replay), 0))
+    return bytes(replay)
+
+
+def build_headers(count=1000, seed=0, locales=(0, 1, 2)) -> list:
+    "Builds file headers with assorted date strings in the replay locales, 0 euro, 1 US, 2 korean."
+
+    rng = random.Random(seed)
+    headers = []
+    for _ in range(count):
+        day, month, year = rng.randint(1, 28), rng.randint(1, 12), rng.randint(2006, 2024)
+        hour, minute = rng.randint(1, 12), rng.randint(0, 59)
+        date = [
+            "{:02}/{:02}/{} {:02}:{:02}".format(day, month, year, hour + 11, minute),
+            "{}/{}/{} {}:{:02} {}M".format(month, day, year, hour, minute, rng.choice("AP")),
+            "{}-{:02}-{:02} {} {}:{:02}".format(year, month, day, rng.choice(["오전", "오후"]), hour, minute),
+        ][rng.choice(locales)]
+        headers.append(int4(8) + b"COH__REC" + date.encode('utf-16le') + b"\x00\x00")
+    return headers
+
+
+def read_header_dates(headers):
+    replay = ReplayAnonymizer()
+    for header in headers:
+        replay.data = header
+        replay.dataIndex = 12
+        replay.read_null_terminated_2_byte_string()
+
+
+def decode_dates(dates):
+    _decode_date.cache_clear()
+    for date in dates:
+        _decode_date(date)
+
+
+def decode_dates_cached(dates):
+    for date in dates:
+        _decode_date(date)
+
+
+def parse(data):
+    replay = ReplayAnonymizer()
+    replay.data = data
+    replay.process_data()
+
+
+def parse_lazy(data):
+    replay = ReplayAnonymizer(lazy=True)
+    replay.data = data
+    replay.process_data()
+
+
+def anonymize(data):
+    replay = ReplayAnonymizer()
+    replay.data = data
+    replay.process_data()
+    replay.replace_username()
+
+
+def read_metadata(filePath):
+    ReplayAnonymizer.read_metadata(filePath)
+
+
+def stream(filePath):
+    replay = ReplayAnonymizer(filePath=filePath, memoryMap=True)
+    replay.save_anonymized(filePath=os.devnull)
+    replay.close()
+
+
+def run_benchmark(name, function, argument, size, repeat, number, files=1) -> dict:
+    "Times function(argument) over files files of size bytes in total and returns its throughput."
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = min(timeit.repeat(
+            lambda: function(argument), repeat=repeat, number=number)) / number
+    result = {
+        'benchmark': name,
+        'seconds': seconds,
+        'filesPerSecond': files / seconds,
+        'MBPerSecond': size / seconds / 1e6,
+    }
+    print("{benchmark:<14} {seconds:>10.6f} s {filesPerSecond:>12.1f} files/s {MBPerSecond:>10.1f} MB/s"
+          .format(**result))
+    return result
+
+
+def measure_footprint(data, count=1000) -> dict:
+    "Measures the bytes per replay of holding parsed replays or their ReplayMeta."
+
+    def held_bytes(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        held = [build() for _ in range(count)]
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del held
+        return size / count
+
+    def parsed_replay():
+        replay = ReplayAnonymizer()
+        replay.data = data
+        replay.process_data()
+        replay.data = None
+        return replay
+
+    result = {
+        'ReplayAnonymizer': held_bytes(parsed_replay),
+        'ReplayMeta': held_bytes(lambda: parsed_replay().metadata()),
+    }
+    for name, size in result.items():
+        print("{:<14} {:>10.0f} bytes per replay held".format(name, size))
+    return result
+
+
+def main(arguments=None) -> list:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the replay parser and anonymizer on synthetic replays.")
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--name-length", type=int, default=12)
+    parser.add_argument("--chat", type=int, default=200, help="number of chat messages")
+    parser.add_argument("--mentions", type=int, default=20, help="chat messages naming a player")
+    parser.add_argument("--size", type=float, default=4, help="replay size in MB")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args(arguments)
+
+    data = build_replay(
+        players=args.players,
+        nameLength=args.name_length,
+        chatMessages=args.chat,
+        mentions=args.mentions,
+        size=int(args.size * 1e6))
+    print("synthetic replay: {} players, {} chat messages, {:.2f} MB".format(
+        args.players, args.chat, len(data) / 1e6))
+
+    headers = build_headers()
+    mixedDates = [header[12:-2].decode('utf-16le') for header in headers]
+    singleDates = [header[12:-2].decode('utf-16le') for header in build_headers(locales=(1,))]
+
+    results = []
+    results.append(run_benchmark(
+        "header_dates", read_header_dates, headers, sum(map(len, headers)), args.repeat, args.number,
+        files=len(headers)))
+    for name, function, dates in [
+            ("dates_mixed", decode_dates, mixedDates),
+            ("dates_single", decode_dates, singleDates),
+            ("dates_cached", decode_dates_cached, mixedDates)]:
+        results.append(run_benchmark(
+            name, function, dates, sum(map(len, dates)) * 2, args.repeat, args.number, files=len(dates)))
+    with tempfile.TemporaryDirectory() as directory:
+        filePath = os.path.join(directory, "synthetic.rec")
+        with open(filePath, "wb") as fileHandle:
+            fileHandle.write(data)
+
+        benchmarks = [
+            ("parse", parse, data),
+            ("parse_lazy", parse_lazy, data),
+            ("read_metadata", read_metadata, filePath),
+            ("anonymize", anonymize, data),
+            ("stream", stream, filePath),
+        ]
+        for name, function, argument in benchmarks:
+            results.append(run_benchmark(name, function, argument, len(data), args.repeat, args.number))
+
+    measure_footprint(data)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,578 @@
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import json
 import logging
+import mmap
 import os
 import re
+import shutil
+import sqlite3
+import struct
 import datetime
 import sys
+import time
+
+from functools import lru_cache, partial
+from typing import NamedTuple, Optional
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # only needed to export metadata as Parquet
+    pyarrow = None
+
+UINT32 = struct.Struct('<I')
+UINT16 = struct.Struct('<H')
+UINT8 = struct.Struct('<B')
+
+# the header relicChunky starts at 76, the second relicChunky 96 bytes later
+SECOND_RELIC_CHUNKY_ADDRESS = 76 + 96
+CHUNK_HEADER_LENGTH = 28
+# offset of chunkLength in a chunk header
+CHUNK_LENGTH_OFFSET = 12
+
+# a pseudonym assigned by NameTable
+PLAYER_NUMBER = re.compile(r"Player (\d+)")
+
+# command streams smaller than this are scanned for names in one region
+PARALLEL_SCAN_BYTES = 32 << 20
+
+# chunkType, chunkVersion, chunkLength, chunkNameLength, 8 unknown bytes
+CHUNK_HEADER = struct.Struct('<8sIII8x')
+# unknown, mapWidth, mapHeight, 3 unknown
+DATASDSC_MAP_SIZE = struct.Struct('<4xII12x')
+# 16 unknown, randomStart, COLS, highResources, TSSR, VP exponent, 5 unknown
+DATABASE_OPTIONS = struct.Struct('<16xI4xI4xI5x')
+# 8 unknown, VP game flag, 23 unknown
+DATABASE_VP_GAME = struct.Struct('<8xI23x')
+# computer, 3 unknown, team, 3 unknown
+DATAINFO_SLOT = struct.Struct('<B3xB3x')
+
+
+# 24hr: DD-MM-YYYY HH:mm, not followed by a US meridiem
+DATE_EURO = re.compile(r"(\d\d).(\d\d).(\d\d\d\d)\s(\d\d).(\d\d)(?!.*?[AaPp]\.?[Mm]\b)")
+# 12hr: MM/DD/YYYY hh:mm XM *numbers are not 0-padded
+DATE_US = re.compile(r"(\d{1,2}).(\d{1,2}).(\d\d\d\d)\s(\d{1,2}).(\d{1,2}).*?([AaPp])\.?[Mm]\b")
+# YYYY/MM/DD HH:MM, korean AM/PM 오후 means PM
+DATE_ASIAN = re.compile(r"(\d\d\d\d).(\d\d).(\d\d)\s([^\u0000-\u007F]+)\s(\d?\d).(\d\d)")
+
+
+def _euro_date(match) -> datetime.datetime:
+    day, month, year, hour, minute = map(int, match.groups())
+    return datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute)
+
+
+def _us_date(match) -> datetime.datetime:
+    month, day, year, hour, minute = map(int, match.groups()[:5])
+    # 12 AM is hour 0, 12 PM is hour 12
+    hour = hour % 12
+    if "p" in match.group(6).lower():
+        hour = hour + 12
+    return datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute)
+
+
+def _asian_date(match) -> datetime.datetime:
+    year, month, day = int(match.group(1)), int(match.group(2)), int(match.group(3))
+    hour, minute = int(match.group(5)) % 12, int(match.group(6))
+    # korean pm
+    if match.group(4) == "오후":
+        hour = hour + 12
+    return datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute)
+
+
+# the formats are mutually exclusive so the order only affects speed,
+# the last format that matched moves to the front as archives are mostly one locale,
+# a tuple rebound in one assignment so a concurrent call always sees every format
+_dateFormats = ((DATE_EURO, _euro_date), (DATE_US, _us_date), (DATE_ASIAN, _asian_date))
+
+
+@lru_cache(maxsize=4096)
+def _decode_date(timeString) -> Optional[datetime.datetime]:
+    "Decodes a replay date string in any of the known locale formats, None if none matches."
+
+    global _dateFormats
+    dateFormats = _dateFormats
+    for position, (pattern, decode) in enumerate(dateFormats):
+        match = pattern.match(timeString)
+        if match:
+            if position:
+                _dateFormats = (dateFormats[position],) + dateFormats[:position] + dateFormats[position+1:]
+            try:
+                return decode(match)
+            except Exception as e:
+                logging.error(str(e))
+                logging.exception("Exception : ")
+    return None
+
+
+class PlayerInfo(NamedTuple):
+    "A player slot parsed from a DATAINFO chunk."
+
+    name: str
+    faction: str
+    team: int
+    # 0, 1, 2, 5 - human, AI, remote human, empty slot
+    computer: int
+
+
+class ReplayMeta(NamedTuple):
+    "Metadata parsed from the header chunks of a replay, players is a tuple of PlayerInfo."
+
+    filePath: str
+    success: bool
+    fileVersion: int
+    localDateString: str
+    localDate: datetime.datetime
+    replayName: str
+    gameVersion: str
+    modName: str
+    mapName: str
+    mapFileName: str
+    mapWidth: int
+    mapHeight: int
+    matchType: str
+    VPCount: int
+    randomStart: bool
+    highResources: bool
+    players: tuple
+
+class AnonymizedReplay(NamedTuple):
+    "The result of anonymizing one replay with anonymize_many."
+
+    # the anonymized replay, None if it could not be anonymized
+    data: Optional[bytearray]
+    # original player name -> pseudonym
+    names: dict
+    success: bool
+    # why the replay failed, empty on success
+    message: str
+
+
+class Chunk(NamedTuple):
+    "A chunk of the relicChunky tree, parent is the index of the enclosing FOLD."
+
+    chunkType: str
+    chunkVersion: int
+    headerOffset: int
+    dataOffset: int
+    length: int
+    parent: Optional[int]
+
+
+class ReplayEdits:
+    "Byte replacements recorded against the original replay data."
+
+    def __init__(self) -> None:
+
+        # offset -> (old_length, new_bytes)
+        self.replacements = {}
+        # offset of a 4 byte little-endian size field -> difference
+        self.size_adjustments = {}
+        # (kind, offset, length, name, size field offsets) of every name
+        # replaced, kind is player, chat or mention, saved as the edit manifest
+        self.occurrences = []
+        # original player name -> pseudonym
+        self.names = {}
+
+        self.__starts = []
+        self.__ends = []
+
+        # set by apply and write
+        self.applied = 0
+        self.bytesCopied = 0
+
+    def overlaps(self, offset, length) -> bool:
+        "Checks if the range overlaps a recorded replacement."
+
+        index = bisect.bisect_right(self.__starts, offset)
+        if index and self.__ends[index - 1] > offset:
+            return True
+        return index < len(self.__starts) and self.__starts[index] < offset + length
+
+    def replace(self, offset, old_length, new_bytes) -> bool:
+        "Records replacing old_length bytes at offset with new_bytes."
+
+        if self.overlaps(offset, old_length):
+            logging.error("Overlapping replacement at %s", offset)
+            return False
+        index = bisect.bisect_right(self.__starts, offset)
+        self.__starts.insert(index, offset)
+        self.__ends.insert(index, offset + old_length)
+        self.replacements[offset] = (old_length, bytes(new_bytes))
+        return True
+
+    def adjust_size(self, offset, difference):
+        "Records adding difference to the size field at offset."
+
+        if difference:
+            self.size_adjustments[offset] = self.size_adjustments.get(offset, 0) + difference
+
+    def replace_name(self, kind, offset, length, name, replacement, sizeFields=()) -> bool:
+        "Records replacing a name occurrence, length prefixed unless a mention, and its size fields."
+
+        if kind == "player":
+            self.names.setdefault(name, replacement.decode('utf-16le'))
+        if kind != "mention":
+            replacement = (len(replacement) // 2).to_bytes(4, 'little') + replacement
+        if not self.replace(offset, length, replacement):
+            return False
+        for sizeField in sizeFields:
+            self.adjust_size(sizeField, len(replacement) - length)
+        self.occurrences.append((kind, offset, length, name, list(sizeFields)))
+        return True
+
+    def output_ranges(self) -> list:
+        "Returns the (start, end) of every replacement in the edited data."
+
+        ranges = []
+        shift = 0
+        for offset in sorted(self.replacements):
+            old_length, new_bytes = self.replacements[offset]
+            ranges.append((offset + shift, offset + shift + len(new_bytes)))
+            shift += len(new_bytes) - old_length
+        return ranges
+
+    @property
+    def in_place(self) -> bool:
+        "True if no edit changes the replay size, so they can be written over the data."
+
+        return not any(self.size_adjustments.values()) and all(
+            len(new_bytes) == old_length for old_length, new_bytes in self.replacements.values())
+
+    def patch(self, data):
+        "Overwrites the replacements in a mutable buffer or writable mmap."
+
+        if not self.in_place:
+            raise ValueError("the edits change the replay size")
+        for offset, (old_length, new_bytes) in self.replacements.items():
+            data[offset:offset+old_length] = new_bytes
+        self.applied = len(self.replacements)
+        self.bytesCopied = 0
+
+    def patch_file(self, fileHandle):
+        "Overwrites the replacements in a file opened for binary update."
+
+        if not self.in_place:
+            raise ValueError("the edits change the replay size")
+        for offset in sorted(self.replacements):
+            fileHandle.seek(offset)
+            fileHandle.write(self.replacements[offset][1])
+        self.applied = len(self.replacements)
+        self.bytesCopied = 0
+
+    def edit_list(self, data) -> list:
+        "Returns the ordered list of (offset, old_length, new_bytes) edits."
+
+        edits = [
+            (offset, old_length, new_bytes)
+            for offset, (old_length, new_bytes) in self.replacements.items()
+        ]
+        for offset, difference in self.size_adjustments.items():
+            old_size = int.from_bytes(data[offset:offset+4], byteorder='little', signed=False)
+            edits.append((offset, 4, (old_size + difference).to_bytes(4, 'little')))
+        edits.sort()
+        return edits
+
+    def apply(self, data) -> bytearray:
+        "Builds the edited data in one pass into a preallocated buffer."
+
+        edits = self.edit_list(data)
+        self.applied = len(edits)
+        self.bytesCopied = len(data) - sum(old_length for _, old_length, _ in edits)
+        size = len(data) + sum(len(new_bytes) - old_length for _, old_length, new_bytes in edits)
+        output = bytearray(size)
+        view = memoryview(data)
+        position = 0
+        output_position = 0
+        for offset, old_length, new_bytes in edits:
+            next_position = output_position + offset - position
+            output[output_position:next_position] = view[position:offset]
+            output_position = next_position + len(new_bytes)
+            output[next_position:output_position] = new_bytes
+            position = offset + old_length
+        output[output_position:] = view[position:]
+        return output
+
+    def write(self, data, fileHandle):
+        "Streams the edited data to an open binary file."
+
+        edits = self.edit_list(data)
+        self.applied = len(edits)
+        self.bytesCopied = len(data) - sum(old_length for _, old_length, _ in edits)
+        view = memoryview(data)
+        position = 0
+        for offset, old_length, new_bytes in edits:
+            fileHandle.write(view[position:offset])
+            fileHandle.write(new_bytes)
+            position = offset + old_length
+        fileHandle.write(view[position:])
+
+
+def fit_pseudonym(pseudonym, width) -> Optional[str]:
+    "Pads or shortens a pseudonym to width characters so the name keeps its size, None if it cannot fit."
+
+    if len(pseudonym) > width:
+        # keep the whole player number, Player 12 -> P12 -> 12
+        number = re.search(r"\d+$", pseudonym)
+        candidates = [pseudonym[:width]]
+        if number:
+            candidates = ["P" + number.group(), number.group()]
+        pseudonym = next(
+            (candidate for candidate in candidates if candidate and len(candidate) <= width), None)
+        if pseudonym is None:
+            return None
+    return pseudonym.ljust(width)
+
+
+class ReplayStats:
+    "Wall time per phase and work counters for one replay."
+
+    def __init__(self) -> None:
+
+        # phase name -> seconds
+        self.phases = {}
+
+        self.chunks = 0
+        self.finds = 0
+        self.edits = 0
+        self.bytesCopied = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        "Adds the wall time of the with block to the named phase."
+
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - startTime
+
+    def as_dict(self) -> dict:
+        return {
+            'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            'chunks': self.chunks,
+            'finds': self.finds,
+            'edits': self.edits,
+            'bytesCopied': self.bytesCopied,
+        }
+
+    def json_line(self, **fields) -> str:
+        "Returns the stats as a single line of JSON, with any extra fields first."
+
+        return json.dumps(dict(fields, **self.as_dict()), ensure_ascii=False)
+
+
+class NameTable:
+    "Maps original player names to pseudonyms that persist across replays."
+
+    def __init__(self, filePath=None, names=None) -> None:
+
+        self.filePath = filePath
+        self.names = dict(names) if names else {}
+        self.changed = False
+        # the number of the next Player #, after every number already in the table
+        self.nextNumber = 1
+
+        if filePath and os.path.isfile(filePath):
+            self.load(filePath)
+        else:
+            self.count_numbers()
+
+    def load(self, filePath=""):
+        with open(filePath, "r", encoding="utf-8") as fileHandle:
+            self.names.update(json.load(fileHandle))
+        self.count_numbers()
+
+    def count_numbers(self):
+        "Sets nextNumber past the highest Player # in the table, which may have gaps or hand edits."
+
+        numbers = [
+            int(match.group(1)) for match in map(PLAYER_NUMBER.fullmatch, self.names.values()) if match]
+        self.nextNumber = max(numbers, default=0) + 1
+
+    def save(self, filePath=""):
+        "Writes the table in one go, only if new names were added."
+
+        filePath = filePath or self.filePath
+        if filePath and self.changed:
+            temporaryPath = filePath + ".tmp"
+            with open(temporaryPath, "w", encoding="utf-8") as fileHandle:
+                json.dump(self.names, fileHandle, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temporaryPath, filePath)
+            self.changed = False
+            logging.info("saved name table as %s", filePath)
+
+    def pseudonym(self, name) -> str:
+        "Returns the pseudonym for name, assigning the next Player # if new."
+
+        replacement = self.names.get(name)
+        if replacement is None:
+            replacement = "Player " + str(self.nextNumber)
+            self.nextNumber += 1
+            self.names[name] = replacement
+            self.changed = True
+        return replacement
+
+
+class ResultCache:
+    "Size bounded LRU cache of anonymized replays keyed by input hash and name mapping."
+
+    # bump when a change to the anonymizer changes its output
+    version = 1
+
+    def __init__(self, directory, maxBytes=1 << 30) -> None:
+
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+        self.hits = 0
+        self.misses = 0
+        self.bytesSaved = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, filePath, names=None, fixedWidth=False) -> str:
+        "Hashes the replay bytes with the pseudonyms its players will get."
+
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update("{}:{}{}".format(
+            self.version, json.dumps(names, sort_keys=True), ":fixed" if fixedWidth else "").encode('utf-8'))
+        with open(filePath, "rb") as fileHandle:
+            for block in iter(partial(fileHandle.read, 1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, key + ".rec")
+
+    def fetch(self, key, outputPath) -> bool:
+        "Copies the cached output to outputPath, returns False on a miss."
+
+        cachedPath = self.path(key)
+        try:
+            shutil.copyfile(cachedPath, outputPath)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        # mark as recently used
+        os.utime(cachedPath)
+        self.hits += 1
+        self.bytesSaved += os.path.getsize(cachedPath)
+        return True
+
+    def store(self, key, outputPath):
+        "Adds an anonymized replay to the cache."
+
+        temporaryPath = self.path(key) + ".tmp"
+        shutil.copyfile(outputPath, temporaryPath)
+        os.replace(temporaryPath, self.path(key))
+
+    def evict(self):
+        "Removes the least recently used entries until the cache fits in maxBytes."
+
+        with os.scandir(self.directory) as entries:
+            cached = [
+                (entry.stat().st_mtime_ns, entry.stat().st_size, entry.path)
+                for entry in entries if entry.name.endswith(".rec")
+            ]
+        totalBytes = sum(size for _, size, _ in cached)
+        for _, size, path in sorted(cached):
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(path)
+            totalBytes -= size
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        return "Cache hits {} of {} ({:.1f}%), {:.1f} MB saved.".format(
+            self.hits, lookups, 100 * self.hits / lookups if lookups else 0.0, self.bytesSaved / 1e6)
+
+
+def _find_all(data, needle, start, end) -> list:
+    "Returns every offset in start..end where needle starts, overlapping ones included."
+
+    # let an occurrence starting before end run past it
+    stop = end + len(needle) - 1
+    positions = []
+    position = data.find(needle, start, stop)
+    while position != -1:
+        positions.append(position)
+        position = data.find(needle, position + 1, stop)
+    return positions
+
+
+def _find_names(data, needles, start, end) -> list:
+    "Returns the _find_all offsets of each needle in start..end."
+
+    return [_find_all(data, needle, start, end) for needle in needles]
+
+
+def _find_names_in_file(filePath, needles, start, end) -> list:
+    "Runs _find_names over a memory map of filePath, for scan worker processes."
+
+    with open(filePath, "rb") as fileHandle, \
+            mmap.mmap(fileHandle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return _find_names(data, needles, start, end)
+
+
+class LazyString:
+    "A replay string field decoded from its recorded offset on first access, then cached."
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, replay, owner=None):
+        if replay is None:
+            return self
+        value = None
+        offset = replay.lazyOffsets.pop(self.name, None)
+        if offset is not None:
+            dataIndex = replay.dataIndex
+            replay.dataIndex = offset
+            value = replay.read_length_string()
+            replay.dataIndex = dataIndex
+        # the instance attribute now hides this descriptor
+        replay.__dict__[self.name] = value
+        return value
 
-from functools import partial
 
 class ReplayAnonymizer:
     "Changes the names in a replay file to Player #."
 
-    def __init__(self, filePath=None) -> None:
+    # only decoded when read if lazy, see read_lazy_string
+    unknownDate = LazyString()
+    replayName = LazyString()
+    mapName = LazyString()
+    mapDescription = LazyString()
+
+    def __init__(self, filePath=None, memoryMap=False, console=True, lazy=False, scanWorkers=1) -> None:
 
         self.filePath = filePath
+        self.memoryMap = memoryMap
+        # print the name mapping and errors, off when used as a library
+        self.console = console
+        # record the offsets of the LazyString fields instead of decoding them
+        self.lazy = lazy
+        # workers searching the command stream for names, see find_names
+        self.scanWorkers = scanWorkers
+
+        self.__data = None
+        self.dataView = None
+        # data holds the unchanged bytes of filePath, see find_names
+        self.dataFromFile = False
+        self.reset()
+
+        if filePath:
+            self.load(self.filePath)
+
+    def reset(self):
+        "Clears the parsed replay so the instance can parse the next one."
 
         self.fileVersion = None
         self.chunkyVersion = None
@@ -33,32 +594,68 @@ class ReplayAnonymizer:
         self.mapWidth = None
         self.mapHeight = None
         self.playerList = []
+        self.chunks = []
 
         self.player_number = -1
+        # stripped pseudonym -> the user_name it replaces, in the current edit plan
+        self.pseudonyms = {}
         self.chunkyHeaderLength = -1
         self.__parent_fold_index = None
 
         self.success = None
 
+        # LazyString field name -> offset of its length prefix
+        self.lazyOffsets = {}
         self.data = None
         self.dataIndex = 0
+        self.edits = ReplayEdits()
+        self.stats = ReplayStats()
+
+    @property
+    def data(self):
+        "The replay bytes, bytes, bytearray or a read only mmap."
+        return self.__data
+
+    @data.setter
+    def data(self, data):
+        if self.dataView is not None:
+            self.dataView.release()
+        self.__data = data
+        self.dataView = memoryview(data) if data is not None else None
+        self.dataFromFile = False
+
+    def close(self):
+        "Releases the replay data, closing the mmap if there is one, lazy fields never read become None."
+
+        # without the data a field still pointing into it cannot be decoded,
+        # read the fields that are needed before closing
+        self.lazyOffsets.clear()
+
+        data = self.data
+        self.data = None
+        if isinstance(data, mmap.mmap):
+            data.close()
 
-        if filePath:
-            self.load(self.filePath)
+    def read_unsigned_int(self, structure) -> int:
+        "Reads a little-endian unsigned int in place using a precompiled struct."
+
+        index = self.dataIndex
+        self.dataIndex += structure.size
+        try:
+            return structure.unpack_from(self.data, index)[0]
+        except struct.error:
+            # fewer bytes left than the int needs
+            return int.from_bytes(
+                self.dataView[index:index+structure.size],
+                byteorder='little',
+                signed=False)
 
     def read_4_bytes_as_unsigned_int(self) -> int:
         "Reads 4 bytes as an unsigned int."
 
         try:
             if self.data:
-                fourBytes = bytearray(
-                    self.data[self.dataIndex:self.dataIndex+4])
-                self.dataIndex += 4
-                theInt = int.from_bytes(
-                    fourBytes,
-                    byteorder='little',
-                    signed=False)
-                return theInt
+                return self.read_unsigned_int(UINT32)
         except Exception as e:
             return None
 
@@ -68,14 +665,7 @@ class ReplayAnonymizer:
 
         try:
             if self.data:
-                twoBytes = bytearray(
-                    self.data[self.dataIndex:self.dataIndex+2])
-                self.dataIndex += 2
-                theInt = int.from_bytes(
-                    twoBytes,
-                    byteorder='little',
-                    signed=False)
-                return theInt
+                return self.read_unsigned_int(UINT16)
         except Exception as e:
             logging.error(str(e))
             logging.error("Failed to read 4 bytes")
@@ -87,14 +677,7 @@ class ReplayAnonymizer:
 
         try:
             if self.data:
-                byte = bytearray(
-                    self.data[self.dataIndex:self.dataIndex+1])
-                self.dataIndex += 1
-                theInt = int.from_bytes(
-                    byte,
-                    byteorder='little',
-                    signed=False)
-                return theInt
+                return self.read_unsigned_int(UINT8)
         except Exception as e:
             logging.error(str(e))
             logging.error("Failed to read 4 bytes")
@@ -130,15 +713,26 @@ class ReplayAnonymizer:
             logging.exception("Stack Trace: ")
             self.success = False
 
+    def read_lazy_string(self, name):
+        "Reads an indexed String into the name field, or only records its offset if lazy."
+
+        if not self.lazy:
+            setattr(self, name, self.read_length_string())
+            return
+        self.__dict__.pop(name, None)
+        self.lazyOffsets[name] = self.dataIndex
+        stringLength = self.read_4_bytes_as_unsigned_int()
+        self.dataIndex += stringLength * 2
+
     def read_2_byte_string(self, stringLength=0) -> str:
         "Reads a 2byte encoded little-endian string of specified length."
 
         try:
             if self.data:
-                theBytes = bytearray(
-                    self.data[self.dataIndex:self.dataIndex+(stringLength*2)])
+                theString = str(
+                    self.dataView[self.dataIndex:self.dataIndex+(stringLength*2)],
+                    'utf-16le')
                 self.dataIndex += stringLength*2
-                theString = theBytes.decode('utf-16le')
                 return theString
         except Exception as e:
             logging.error(str(e))
@@ -164,9 +758,9 @@ class ReplayAnonymizer:
         "Reads an ASCII string of specfied length."
         try:
             if self.data:
-                theBytes = bytearray(
-                    self.data[self.dataIndex:self.dataIndex+stringLength])
-                theString = theBytes.decode('ascii')
+                theString = str(
+                    self.dataView[self.dataIndex:self.dataIndex+stringLength],
+                    'ascii')
                 self.dataIndex += stringLength
                 return theString
         except UnicodeDecodeError:
@@ -181,12 +775,16 @@ class ReplayAnonymizer:
 
         try:
             if self.data:
-                characters = ""
-                for character in iter(
-                        partial(self.read_bytes, 2),
-                        bytearray(b"\x00\x00")
-                ):
-                    characters += bytearray(character).decode('utf-16le')
+                start = self.dataIndex
+                end = self.data.find(b"\x00\x00", start)
+                # the terminator must be a whole character
+                while end != -1 and (end - start) % 2:
+                    end = self.data.find(b"\x00\x00", end + 1)
+                if end == -1:
+                    # ran out of data before the terminator
+                    end = len(self.data)
+                characters = str(self.dataView[start:end], 'utf-16le')
+                self.dataIndex = min(end + 2, len(self.data))
                 return characters
         except Exception as e:
             logging.error(str(e))
@@ -199,12 +797,13 @@ class ReplayAnonymizer:
 
         try:
             if self.data:
-                characters = ""
-                for character in iter(
-                    partial(self.read_bytes, 1),
-                    bytearray(b"\x00")
-                ):
-                    characters += bytearray(character).decode('ascii')
+                start = self.dataIndex
+                end = self.data.find(b"\x00", start)
+                if end == -1:
+                    # ran out of data before the terminator
+                    end = len(self.data)
+                characters = str(self.dataView[start:end], 'ascii')
+                self.dataIndex = min(end + 1, len(self.data))
                 return characters
         except Exception as e:
             logging.error(str(e))
@@ -240,16 +839,82 @@ class ReplayAnonymizer:
             logging.exception("Stack Trace: ")
 
     def load(self, filePath=""):
-        with open(filePath, "rb") as fileHandle:
-            self.data = fileHandle.read()
+        with self.stats.phase("load"), open(filePath, "rb") as fileHandle:
+            if self.memoryMap and os.fstat(fileHandle.fileno()).st_size:
+                self.data = mmap.mmap(fileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = fileHandle.read()
+        self.filePath = filePath
+        self.dataFromFile = True
         success = self.process_data()
-        if not success:
+        if not success and self.console:
             print("Invalid replay file.\n Please provide a valid replay.")
 
+    @classmethod
+    def read_metadata(cls, filePath) -> ReplayMeta:
+        "Reads only the header chunks of a replay and returns its metadata."
+
+        replay = cls()
+        replay.filePath = filePath
+        with replay.stats.phase("load"), open(filePath, "rb") as fileHandle:
+            replay.data = replay.read_header_bytes(fileHandle)
+        replay.process_data()
+        return replay.metadata()
+
+    def read_header_bytes(self, fileHandle) -> bytes:
+        "Reads the file header and both relicChunky headers with bounded reads."
+
+        data = bytearray()
+
+        def read_to(end):
+            if end > len(data):
+                data.extend(fileHandle.read(end - len(data)))
+            return len(data) >= end
+
+        if not read_to(SECOND_RELIC_CHUNKY_ADDRESS + 28):
+            return bytes(data)
+        chunkEnd = SECOND_RELIC_CHUNKY_ADDRESS + UINT32.unpack_from(
+            data, SECOND_RELIC_CHUNKY_ADDRESS + 24)[0]
+
+        # process_data parses two chunks after the second relicChunky header
+        for _ in range(2):
+            if not read_to(chunkEnd + CHUNK_HEADER_LENGTH):
+                return bytes(data)
+            chunkLength, chunkNameLength = struct.unpack_from('<II', data, chunkEnd + 12)
+            chunkEnd += CHUNK_HEADER_LENGTH + chunkNameLength + chunkLength
+        read_to(chunkEnd)
+        return bytes(data)
+
+    def metadata(self) -> ReplayMeta:
+        "Returns the parsed metadata as a ReplayMeta."
+
+        def intern(value):
+            # shared by many replays of an archive
+            return sys.intern(value) if value else value
+
+        return ReplayMeta(
+            filePath=self.filePath,
+            success=self.success,
+            fileVersion=self.fileVersion,
+            localDateString=self.localDateString,
+            localDate=self.localDate,
+            replayName=self.replayName,
+            gameVersion=intern(self.gameVersion),
+            modName=intern(self.modName),
+            mapName=self.mapName,
+            mapFileName=intern(self.mapFileName),
+            mapWidth=self.mapWidth,
+            mapHeight=self.mapHeight,
+            matchType=intern(self.matchType),
+            VPCount=self.VPCount,
+            randomStart=self.randomStart,
+            highResources=self.highResources,
+            players=tuple(self.playerList))
+
     def save(self, filePath=""):
 
         if filePath:
-            with open(filePath, "wb") as binary_file:
+            with self.stats.phase("save"), open(filePath, "wb") as binary_file:
                 # Write bytes to file
                 binary_file.write(self.data)
             logging.info("saved as %s", filePath)
@@ -257,8 +922,17 @@ class ReplayAnonymizer:
     def process_data(self) -> bool:
         "Processes replay byte data."
 
+        with self.stats.phase("parse"):
+            return self.parse_data()
+
+    def parse_data(self) -> bool:
+        "Parses the file header and the chunks of the second relicChunky."
+
         # Set return flag
         self.success = True
+        self.chunks = []
+        # the anonymized data is parsed again by the same instance
+        self.dataIndex = 0
 
         # Process the file Header
         self.fileVersion = self.read_4_bytes_as_unsigned_int()  # int (8)
@@ -272,8 +946,6 @@ class ReplayAnonymizer:
 
         self.seek(76, 0)
 
-        firstRelicChunkyAddress = self.dataIndex
-        
         self.read_ASCII_string(stringLength=12)  # relicChunky
 
         self.read_4_bytes_as_unsigned_int()  # unknown
@@ -287,8 +959,7 @@ class ReplayAnonymizer:
         self.seek(-28, 1)  # sets file pointer back to start of relic chunky
         self.seek(self.chunkyHeaderLength, 1)  # seeks to begining of FOLDPOST
 
-        self.seek(firstRelicChunkyAddress, 0)
-        self.seek(96, 1)
+        self.seek(SECOND_RELIC_CHUNKY_ADDRESS, 0)
         # move pointer to the position of the second relic chunky
 
         secondRelicChunkyAddress = self.dataIndex
@@ -303,91 +974,117 @@ class ReplayAnonymizer:
         self.seek(secondRelicChunkyAddress, 0)
         self.seek(chunkLength, 1)  # seek to position of first viable chunk
 
-        self.parse_chunk()
-        self.parse_chunk()
+        # FOLDINFO then DATASDSC
+        for chunk in self.walk_chunks(self.dataIndex, count=2):
+            self.chunks.append(chunk)
+            self.parse_chunk(chunk)
 
         return self.success
 
-    def parse_chunk(self):
-
-        chunkType = self.read_ASCII_string(stringLength=8)
-        # Reads FOLDFOLD, FOLDDATA, DATASDSC, DATAINFO etc
-
-        #logging.info(chunkType)
-
-        chunkVersion = self.read_4_bytes_as_unsigned_int()
-
-        chunkLength = self.read_4_bytes_as_unsigned_int()
-
-        chunkNameLength = self.read_4_bytes_as_unsigned_int()
-
-        self.seek(8, 1)
-
-        if chunkNameLength > 0:
-            self.read_ASCII_string(stringLength=chunkNameLength)  # chunkName
-
-        chunkStart = self.dataIndex
-
-        # Here we start a recusive loop
-        if chunkType:
-            if (chunkType.startswith("FOLD")):
+    def read_struct(self, structure) -> tuple:
+        "Reads a fixed layout block of fields with a precompiled struct."
 
-                while (self.dataIndex < (chunkStart + chunkLength)):
-                    self.parse_chunk()
-
-        if (chunkType == "DATASDSC") and (int(chunkVersion) == 2004):
-
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.unknownDate = self.read_length_string()
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.read_4_bytes_as_unsigned_int()  # unknown
+        index = self.dataIndex
+        self.dataIndex += structure.size
+        try:
+            return structure.unpack_from(self.data, index)
+        except struct.error:
+            # fewer bytes left than the block needs, missing bytes read as 0
+            return structure.unpack(
+                bytes(self.dataView[index:index+structure.size]).ljust(structure.size, b"\x00"))
+
+    def walk_chunks(self, offset, count=1):
+        "Yields a Chunk for count top level chunks from offset and every chunk in their folders."
+
+        # FOLD chunks are entered with an explicit stack rather than recursion.
+        # Chunk.parent is the index of the enclosing folder in yield order.
+        # dataIndex is at the chunk data when a chunk is yielded so the consumer
+        # can read it, the walk carries on from the end of the chunk whatever
+        # the consumer read, and the consumer can stop at any chunk.
+
+        data = self.data
+        size = len(data)
+        # (end, index) of the enclosing FOLD chunks
+        folders = []
+        index = 0
+        position = offset
+        while folders or count:
+            if not folders:
+                count -= 1
+
+            headerOffset = position
+            try:
+                chunkType, chunkVersion, chunkLength, chunkNameLength = CHUNK_HEADER.unpack_from(
+                    data, position)
+                chunkType = chunkType.decode('ascii')
+            except (struct.error, UnicodeDecodeError, TypeError):
+                chunkType = None
+            # skip the header and the chunkName
+            chunkStart = position + CHUNK_HEADER.size + (chunkNameLength if chunkType else 0)
+            if chunkType is None or chunkStart > size:
+                # truncated or corrupt chunk header
+                logging.error("Invalid chunk header at %s", chunkStart)
+                self.success = False
+                return
+
+            self.stats.chunks += 1
+            self.dataIndex = chunkStart
+            yield Chunk(
+                chunkType, chunkVersion, headerOffset, chunkStart, chunkLength,
+                folders[-1][1] if folders else None)
+
+            chunkEnd = chunkStart + chunkLength
+            if chunkType.startswith("FOLD"):
+                folders.append((chunkEnd, index))
+                position = chunkStart
+            elif chunkEnd <= size:
+                position = chunkEnd
+            else:
+                logging.error("Chunk at %s ends past the data", headerOffset)
+                position = self.dataIndex
+            index += 1
+
+            # leave every folder whose chunks have all been read
+            while folders and position >= folders[-1][0]:
+                folderEnd = folders.pop()[0]
+                if folderEnd <= size:
+                    position = folderEnd
+
+    def parse_chunk(self, chunk):
+        "Reads the fields of a DATASDSC, DATABASE or DATAINFO chunk, dataIndex is at its data."
+
+        chunkType = chunk.chunkType
+        chunkVersion = chunk.chunkVersion
+
+        if (chunkType == "DATASDSC") and (chunkVersion == 2004):
+
+            self.seek(4, 1)  # unknown
+            self.read_lazy_string("unknownDate")
+            self.seek(12, 1)  # unknown
             self.modName = self.read_length_ASCII_string()
             self.mapFileName = self.read_length_ASCII_string()
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.mapName = self.read_length_string()
+            self.seek(20, 1)  # unknown
+            self.read_lazy_string("mapName")
 
             value = self.read_4_bytes_as_unsigned_int()
             if value != 0:  # test to see if data is replicated or not
-                self.read_2_byte_string(value)  # unknown
-            self.mapDescription = self.read_length_string()
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.mapWidth = self.read_4_bytes_as_unsigned_int()
-            self.mapHeight = self.read_4_bytes_as_unsigned_int()
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.read_4_bytes_as_unsigned_int()  # unknown
-            self.read_4_bytes_as_unsigned_int()  # unknown
+                self.dataIndex += value * 2  # unknown
+            self.read_lazy_string("mapDescription")
+            self.mapWidth, self.mapHeight = self.read_struct(DATASDSC_MAP_SIZE)
 
-        if (chunkType == "DATABASE") and (int(chunkVersion == 11)):
+        if (chunkType == "DATABASE") and (chunkVersion == 11):
 
-            self.seek(16, 1)
-
-            self.randomStart = True
-            self.randomStart = (self.read_4_bytes_as_unsigned_int() == 0)
+            randomStart, highResources, VPExponent = self.read_struct(DATABASE_OPTIONS)
+            self.randomStart = (randomStart == 0)
             #  0 is fixed 1 is random
 
-            self.read_4_bytes_as_unsigned_int()  # COLS
-
-            self.highResources = (self.read_4_bytes_as_unsigned_int() == 1)
-
-            self.read_4_bytes_as_unsigned_int()  # TSSR
+            self.highResources = (highResources == 1)
 
-            self.VPCount = 250 * (1 << (int)(
-                self.read_4_bytes_as_unsigned_int()))
+            self.VPCount = 250 * (1 << VPExponent)
 
-            self.seek(5, 1)
+            self.read_lazy_string("replayName")
 
-            self.replayName = self.read_length_string()
-
-            self.seek(8, 1)
-
-            self.VPGame = (self.read_4_bytes_as_unsigned_int() == 0x603872a3)
-
-            self.seek(23, 1)
+            self.VPGame = (self.read_struct(DATABASE_VP_GAME)[0] == 0x603872a3)
 
             self.read_length_ASCII_string() # gameminorversion
 
@@ -410,87 +1107,218 @@ class ReplayAnonymizer:
         if (chunkType == "DATAINFO") and (chunkVersion == 6):
 
             userName = self.read_length_string()
-            computer = self.read_byte_as_unsigned_int() # 0, 1, 2, 5 - human, AI, remote human, empty slot
-            self.read_byte_as_unsigned_int()
-            self.read_byte_as_unsigned_int()
-            self.read_byte_as_unsigned_int()
-            team = self.read_byte_as_unsigned_int() # 0 , 1
-            self.read_byte_as_unsigned_int()
-            self.read_byte_as_unsigned_int()
-            self.read_byte_as_unsigned_int()
+            computer, team = self.read_struct(DATAINFO_SLOT)
+            # computer 0, 1, 2, 5 - human, AI, remote human, empty slot
+            # team 0 , 1
             faction = self.read_length_ASCII_string()
-            self.read_4_bytes_as_unsigned_int()
-            self.read_4_bytes_as_unsigned_int()
+            if faction:
+                # the same few factions repeat in every replay
+                faction = sys.intern(faction)
+
+            self.playerList.append(PlayerInfo(userName, faction, team, computer))
+
+
+    def replace_username(self, nameTable=None, fixedWidth=False, manifestPath=None):
+        "Replaces every player name in the replay with Player # or its nameTable pseudonym."
+
+        self.plan_username_edits(nameTable=nameTable, fixedWidth=fixedWidth, manifestPath=manifestPath)
+
+        if self.edits.in_place:
+            # no size changes, overwrite the names without rebuilding the data
+            with self.stats.phase("apply"):
+                if not isinstance(self.data, bytearray):
+                    self.data = bytearray(self.data)
+                self.edits.patch(self.data)
+            self.stats.edits += self.edits.applied
+
+            # the chunk index still holds, only the player names changed
+            names = []
+            for chunk in self.chunks:
+                if chunk.chunkType == "DATAINFO":
+                    self.seek(chunk.dataOffset, 0)
+                    names.append(self.read_length_string())
+            self.playerList = [
+                player._replace(name=name) for player, name in zip(self.playerList, names)]
+            return
+
+        # Write every recorded edit in a single pass
+        with self.stats.phase("apply"):
+            self.data = self.edits.apply(self.data)
+        self.stats.edits += self.edits.applied
+        self.stats.bytesCopied += self.edits.bytesCopied
+
+        # index the chunks of the anonymized data
+        self.playerList.clear()
+        self.process_data()
 
-            self.playerList.append({'name': userName, 'faction': faction, 'team': team, 'computer' : computer})
+    def patch_file(self, filePath="", nameTable=None, fixedWidth=True, manifestPath=None) -> bool:
+        "Overwrites the names in filePath, a copy of the input, without writing the rest of the replay."
 
-        self.seek(chunkStart + chunkLength, 0)
+        self.plan_username_edits(nameTable=nameTable, fixedWidth=fixedWidth, manifestPath=manifestPath)
+        if not self.edits.in_place:
+            logging.error("Pseudonyms change the replay size, %s cannot be patched in place", filePath)
+            return False
 
+        filePath = filePath or self.filePath
+        with self.stats.phase("save"):
+            if os.path.abspath(filePath) != os.path.abspath(self.filePath):
+                shutil.copyfile(self.filePath, filePath)
+            with open(filePath, "r+b") as binary_file:
+                self.edits.patch_file(binary_file)
+        self.stats.edits += self.edits.applied
+        logging.info("patched %s", filePath)
+        return True
 
-    def replace_username(self):
-        "Processes replay byte data."
+    def save_anonymized(self, filePath="", nameTable=None, fixedWidth=False, manifestPath=None):
+        "Streams the anonymized replay to filePath without rebuilding it in memory."
 
-        self.playerList.clear()
-        self.player_number = 1
-        self.dataIndex = 0
+        self.plan_username_edits(nameTable=nameTable, fixedWidth=fixedWidth, manifestPath=manifestPath)
 
-        while True:
-            user_name_header_location = self.data.find('DATAINFO'.encode('ASCII'), self.dataIndex)
-            
-            if user_name_header_location == -1:
-                break
+        if filePath:
+            with self.stats.phase("save"), open(filePath, "wb") as binary_file:
+                # copy the unchanged ranges straight from the input data
+                self.edits.write(self.data, binary_file)
+            self.stats.edits += self.edits.applied
+            self.stats.bytesCopied += self.edits.bytesCopied
+            logging.info("saved as %s", filePath)
 
-            folder_size_location = user_name_header_location - 16
-            self.seek(folder_size_location, 0)
-            folder_size = self.read_4_bytes_as_unsigned_int()
+    def plan_username_edits(self, nameTable=None, fixedWidth=False, manifestPath=None) -> ReplayEdits:
+        "Records the edits replacing every player name without changing the data."
 
-            chunk_size_location = user_name_header_location + 12
-            self.seek(chunk_size_location, 0)
-            chunk_size = self.read_4_bytes_as_unsigned_int()
+        if manifestPath:
+            manifest = self.load_manifest(manifestPath)
+            if manifest is not None:
+                # the name offsets are already known, no scan needed
+                with self.stats.phase("manifest"):
+                    self.plan_manifest_edits(manifest, nameTable=nameTable, fixedWidth=fixedWidth)
+                return self.edits
 
-            user_name_read_location = user_name_header_location + 28
-            self.seek(user_name_read_location, 0)
-            user_name = self.read_length_string()
-            user_name_size = len(user_name)
-            user_name_size_bytes = user_name_size * 2
+        with self.stats.phase("rename"):
+            replacements = self.plan_player_edits(nameTable=nameTable, fixedWidth=fixedWidth)
+
+        # Replace ALL chat messages
+        with self.stats.phase("chat"):
+            self.replace_all_chat_messages(replacements, strip=not fixedWidth)
+
+        if manifestPath:
+            self.save_manifest(manifestPath)
 
+        return self.edits
+
+    def player_pseudonym(self, user_name, width, nameTable=None, fixedWidth=False) -> str:
+        "Returns the replacement for the next player name, width is the name length in characters."
+
+        if nameTable is not None:
+            replacement_user_name = nameTable.pseudonym(user_name)
+        else:
             replacement_user_name = "Player " + str(self.player_number)
-            self.player_number += 1
-            replacement_user_name_size = len(replacement_user_name)
-            replacement_user_name_size_bytes = replacement_user_name_size * 2
-
-            replacement_user_name_size_int4 = replacement_user_name_size.to_bytes(4, 'little')
-            replacement_user_name_bytes = bytes(replacement_user_name.strip().encode('utf-16le'))
-                
-            output = f"'{user_name}' ---> '{replacement_user_name}'"
+        if fixedWidth:
+            fitted = fit_pseudonym(replacement_user_name, width)
+            if fitted is not None and self.pseudonyms.get(fitted.strip(), user_name) == user_name:
+                replacement_user_name = fitted
+            else:
+                # keep the full pseudonym, changing the name size, rather than share one
+                logging.warning("'%s' does not fit %s characters uniquely", replacement_user_name, width)
+        self.pseudonyms[replacement_user_name.strip()] = user_name
+        self.player_number += 1
+
+        output = f"'{user_name}' ---> '{replacement_user_name}'"
+        if self.console:
             print(output)
-            logging.info(output)
+        logging.info(output)
+        return replacement_user_name
+
+    def manifest_digest(self) -> str:
+        return hashlib.blake2b(self.data, digest_size=20).hexdigest()
+
+    def save_manifest(self, filePath):
+        "Writes the name occurrences of the last edit plan as a JSON sidecar."
+
+        manifest = {
+            'version': 1,
+            'size': len(self.data),
+            'digest': self.manifest_digest(),
+            'occurrences': self.edits.occurrences,
+        }
+        temporaryPath = filePath + ".tmp"
+        with open(temporaryPath, "w", encoding="utf-8") as fileHandle:
+            json.dump(manifest, fileHandle, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temporaryPath, filePath)
+        logging.info("saved edit manifest as %s", filePath)
+
+    def load_manifest(self, filePath) -> Optional[dict]:
+        "Returns the manifest saved for this replay, None if missing or made from other data."
 
-            bytes_size_difference = (user_name_size_bytes - replacement_user_name_size_bytes)
+        try:
+            with open(filePath, "r", encoding="utf-8") as fileHandle:
+                manifest = json.load(fileHandle)
+        except (OSError, ValueError):
+            return None
+        if (manifest.get('version') != 1 or manifest.get('size') != len(self.data)
+                or manifest.get('digest') != self.manifest_digest()):
+            logging.info("edit manifest %s does not match the replay", filePath)
+            return None
+        return manifest
 
-            start = user_name_read_location
-            end = self.dataIndex
+    def plan_manifest_edits(self, manifest, nameTable=None, fixedWidth=False) -> ReplayEdits:
+        "Records the edits for a new name mapping from the occurrences listed in a manifest."
 
-            # replace user name
-            self.data = self.data[:start] + replacement_user_name_size_int4 + replacement_user_name_bytes + self.data[end:]
+        self.player_number = 1
+        self.pseudonyms = {}
+        self.edits = ReplayEdits()
+
+        replacements = {}
+        # player occurrences come first, in DATAINFO order
+        for kind, offset, length, name, sizeFields in manifest['occurrences']:
+            if kind == "player":
+                replacement = self.player_pseudonym(name, (length - 4) // 2, nameTable, fixedWidth)
+                replacements.setdefault(name, replacement)
+            else:
+                replacement = replacements[name]
+                if not fixedWidth:
+                    replacement = replacement.strip()
+            self.edits.replace_name(kind, offset, length, name, replacement.encode('utf-16le'), sizeFields)
+
+        return self.edits
+
+    def plan_player_edits(self, nameTable=None, fixedWidth=False) -> dict:
+        "Records the DATAINFO name edits, returns the user_name to replacement mapping."
 
-            new_chunk_size = chunk_size - bytes_size_difference
-            # set the new chunk size
-            self.data = self.data[:chunk_size_location] + new_chunk_size.to_bytes(4, 'little') + self.data[chunk_size_location+4:]
+        self.player_number = 1
+        self.pseudonyms = {}
+        self.dataIndex = 0
+        self.edits = ReplayEdits()
+
+        replacements = {}
+
+        for chunkIndex, chunk in enumerate(self.chunks):
+            if chunk.chunkType != "DATAINFO":
+                continue
+
+            user_name_read_location = chunk.dataOffset
+            self.seek(user_name_read_location, 0)
+            user_name = self.read_length_string()
+            user_name_size_bytes = self.dataIndex - user_name_read_location - 4
 
-            new_folder_size = folder_size - bytes_size_difference
-            # set the new folder size
-            self.data = self.data[:folder_size_location] + new_folder_size.to_bytes(4, 'little') + self.data[folder_size_location+4:]
+            replacement_user_name = self.player_pseudonym(
+                user_name, user_name_size_bytes // 2, nameTable, fixedWidth)
 
-            # Resize header
-            self.resize_header(size_difference=bytes_size_difference)
+            # replace user name, set the new chunk size and the size of every enclosing folder
+            self.edits.replace_name(
+                "player",
+                user_name_read_location,
+                self.dataIndex - user_name_read_location,
+                user_name,
+                replacement_user_name.encode('utf-16le'),
+                self.chunk_size_fields(chunkIndex))
 
-            # Replace ALL chat messages
-            self.replace_all_chat_messages(user_name=user_name, replacement=replacement_user_name)
+            replacements.setdefault(user_name, replacement_user_name)
 
+        return replacements
 
-    def replace_all_chat_messages(self, user_name : str, replacement : str):
-        "user_name must be encoded as utf-16le"
+
+    def replace_all_chat_messages(self, replacements : dict, strip=True):
+        "Replaces every occurrence of each user_name key with its replacement."
         """
         messages seems to be of the type
         int4 (total_size?) int4 (1) int4 (inner total_size?) NameString int4 (userid) int4 (0) int4 (1) int4 (messagessize) Message
@@ -500,154 +1328,204 @@ class ReplayAnonymizer:
         # store the current data index
         temp = self.dataIndex
 
-        while (self.data.find(user_name.encode('utf-16le')) != -1):
-            start = self.data.find(user_name.encode('utf-16le')) - 4
+        replacement_bytes = {
+            user_name.encode('utf-16le'): (replacement.strip() if strip else replacement).encode('utf-16le')
+            for user_name, replacement in replacements.items()
+            if user_name
+        }
+        if not replacement_bytes:
+            return
+
+        # longest names first so a name containing another name wins,
+        # as the first alternative of a regular expression would
+        needles = sorted(replacement_bytes, key=len, reverse=True)
+        positions = self.find_names(needles)
+        occurrences = sorted(
+            (location, rank)
+            for rank, user_name_bytes in enumerate(needles)
+            for location in positions[user_name_bytes])
+
+        # leftmost match first, never overlapping the previous one
+        data = self.data
+        position = 0
+        for location, rank in occurrences:
+            if location < position:
+                continue
+            user_name_bytes = needles[rank]
+            end = location + len(user_name_bytes)
+            if self.edits.overlaps(location, end - location):
+                # already rewritten eg: the name in the DATAINFO chunk
+                position = location + 1
+                continue
+            position = end
+
+            replacement = replacement_bytes[user_name_bytes]
+
+            start = location - 4
             # check chat message is a message and not the persons name mentioned in chat or
             # the name in a lag message
             # the 4 bytes before the user name should be the length of the string
             # the 4 bytes after the user name should be the user id between 1000 and 1007
-            self.seek(start, 0)
-            user_name_length = self.read_4_bytes_as_unsigned_int()
-
-            user_id_location = start + 4 + len(user_name) * 2
-            self.seek(user_id_location, 0)
-            user_id = self.read_4_bytes_as_unsigned_int()
+            user_name_length = UINT32.unpack_from(data, start)[0] if start >= 0 else None
+            user_id = int.from_bytes(data[end:end+4], byteorder='little', signed=False)
 
-            if user_name_length != len(user_name) or not (1000 <= user_id <= 1007):
+            user_name = user_name_bytes.decode('utf-16le')
+            if user_name_length != len(user_name_bytes) // 2 or not (1000 <= user_id <= 1007):
                 # not a chat message just replace the name with replacement
-                replacement_bytes = bytes(replacement.strip().encode('utf-16le'))
-                end = start + 4 + (len(user_name) * 2)
-                self.data = self.data[:start + 4] + replacement_bytes + self.data[end:]
-                continue
+                self.edits.replace_name("mention", location, len(user_name_bytes), user_name, replacement)
+            elif self.edits.overlaps(start, location - start):
+                # the length prefix is part of an earlier edit, replace the name alone
+                self.edits.replace_name("mention", location, len(user_name_bytes), user_name, replacement)
+            else:
+                # set size of message and size of entire message
+                self.edits.replace_name(
+                    "chat", start, end - start, user_name, replacement, (start - 4, start - 12))
 
-            end = start + 4 + (len(user_name) * 2)
-            size_of_replacement = len(replacement)
-            replacement_size = size_of_replacement.to_bytes(4, 'little')
-            replacement_bytes = bytes(replacement.strip().encode('utf-16le'))
-            self.data = self.data[:start] + replacement_size + replacement_bytes + self.data[end:]
-            # set size of message
-            start = start - 4
-            end = start + 4
-            self.dataIndex = start
-            original_size = self.read_4_bytes_as_unsigned_int()
-            new_size = original_size - (len(user_name) - len(replacement)) * 2
-            self.data = self.data[:start] + new_size.to_bytes(4, 'little') + self.data[end:]
-            # set size of entire message
-            start = start - 8
-            end = start + 4
-            self.dataIndex = start
-            original_size = self.read_4_bytes_as_unsigned_int()
-            new_size = original_size - (len(user_name) - len(replacement)) * 2
-            self.data = self.data[:start] + new_size.to_bytes(4, 'little') + self.data[end:]
-
-        
         # reset the curent dataIndex back to its original value
         self.dataIndex = temp
 
-
-    def resize_header(self, size_difference):
-        "resizes the header"
-        # store current dataIndex
-        temp = self.dataIndex
-        foldinfo_location = self.data.find("FOLDINFO".encode('ASCII'))
-
-        start = foldinfo_location + 12
-        end = foldinfo_location + 16
-
-        self.seek(start, 0)
-        old_size = self.read_4_bytes_as_unsigned_int()
-        new_size = old_size - size_difference
-
-        self.data = self.data[:start] + new_size.to_bytes(4, 'little') + self.data[end:]
-        # set dataIndex back to its original value
-        self.dataIndex = temp
-
+    def scan_regions(self) -> list:
+        "Splits the data into the header chunks and scanWorkers equal parts of the command stream."
+
+        headerEnd = min(
+            max((chunk.dataOffset + chunk.length for chunk in self.chunks if chunk.parent is None), default=0),
+            len(self.data))
+        regions = [(0, headerEnd)]
+        streamLength = len(self.data) - headerEnd
+        parts = self.scanWorkers if streamLength >= PARALLEL_SCAN_BYTES else 1
+        for part in range(parts):
+            regions.append((
+                headerEnd + streamLength * part // parts,
+                headerEnd + streamLength * (part + 1) // parts))
+        return [(start, end) for start, end in regions if end > start]
+
+    def find_names(self, needles) -> dict:
+        "Returns every offset of each needle, searching the scan_regions in parallel if scanWorkers > 1."
+
+        # Neither bytes.find nor re release the GIL, so the regions of a replay
+        # loaded from a file are searched in worker processes that map the file
+        # themselves. In memory data is searched in threads, which only run in
+        # parallel on a free-threaded Python.
+
+        regions = self.scan_regions()
+        starts, ends = [start for start, _ in regions], [end for _, end in regions]
+        # the header region and more than one part of the command stream
+        if self.scanWorkers > 1 and len(regions) > 2:
+            if self.dataFromFile:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.scanWorkers) as executor:
+                    results = list(executor.map(
+                        partial(_find_names_in_file, self.filePath, needles), starts, ends))
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.scanWorkers) as executor:
+                    results = list(executor.map(partial(_find_names, self.data, needles), starts, ends))
+        else:
+            results = [_find_names(self.data, needles, start, end) for start, end in regions]
+
+        positions = {needle: [] for needle in needles}
+        for regionPositions in results:
+            for needle, found in zip(needles, regionPositions):
+                positions[needle] += found
+                self.stats.finds += len(found) + 1
+        return positions
+
+
+    def chunk_size_fields(self, chunkIndex) -> list:
+        "Returns the offsets of the size fields of a chunk and all of its parent folders."
+
+        sizeFields = []
+        while chunkIndex is not None:
+            chunk = self.chunks[chunkIndex]
+            sizeFields.append(chunk.headerOffset + CHUNK_LENGTH_OFFSET)
+            chunkIndex = chunk.parent
+        return sizeFields
+
+    def verify(self, ranges=None, names=None) -> list:
+        "Checks the anonymized replay data, returns a description of each problem found."
+
+        # Walks the chunk tree once, checking that every FOLD length is the sum
+        # of its chunks and that no DATAINFO holds an original name. The bytes
+        # between the replaced ranges are copies of data the planning scan
+        # already searched, so original names are only looked for where a
+        # replacement meets its neighbours.
+
+        if ranges is None:
+            ranges = self.edits.output_ranges()
+        if names is None:
+            names = self.edits.names
+
+        with self.stats.phase("verify"):
+            problems = []
+            data = self.data
+
+            # names that are, or are part of, a pseudonym can legitimately remain
+            pseudonyms = set(names.values())
+            originals = [
+                name for name in names
+                if name and not any(name in pseudonym for pseudonym in pseudonyms)
+            ]
+
+            if len(data) < SECOND_RELIC_CHUNKY_ADDRESS + 28:
+                return ["the replay is truncated before the second relicChunky"]
+            offset = SECOND_RELIC_CHUNKY_ADDRESS + UINT32.unpack_from(
+                data, SECOND_RELIC_CHUNKY_ADDRESS + 24)[0]
+
+            success = self.success
+            self.success = True
+            # index -> (FOLD chunk, total length of its chunks)
+            folders = {}
+            index = 0
+            for chunk in self.walk_chunks(offset, count=2):
+                if chunk.parent is not None:
+                    folder, total = folders[chunk.parent]
+                    folders[chunk.parent] = (folder, total + chunk.dataOffset + chunk.length - chunk.headerOffset)
+                if chunk.chunkType.startswith("FOLD"):
+                    folders[index] = (chunk, 0)
+                elif chunk.chunkType == "DATAINFO":
+                    userName = self.read_length_string()
+                    if userName in originals:
+                        problems.append("DATAINFO at {} still holds '{}'".format(chunk.headerOffset, userName))
+                index += 1
+            if not self.success:
+                problems.append("the chunk tree does not parse")
+            self.success = success
+
+            for folder, total in folders.values():
+                if folder.length != total:
+                    problems.append("{} at {} has length {} but its chunks take {}".format(
+                        folder.chunkType, folder.headerOffset, folder.length, total))
+
+            if originals and ranges:
+                pattern = re.compile(b"|".join(
+                    re.escape(name.encode('utf-16le')) for name in originals))
+                reach = max(len(name) for name in originals) * 2 - 1
+                for start, end in ranges:
+                    match = pattern.search(data, max(start - reach, 0), end + reach)
+                    if match:
+                        problems.append("'{}' remains at {}".format(
+                            match.group().decode('utf-16le', 'replace'), match.start()))
+
+        for problem in problems:
+            logging.error("Verification failed: %s", problem)
+        return problems
+
+    def verify_file(self, filePath) -> list:
+        "Verifies the replay written by save_anonymized or patch_file against the planned edits."
+
+        output = ReplayAnonymizer()
+        with self.stats.phase("verify"), open(filePath, "rb") as fileHandle:
+            if os.fstat(fileHandle.fileno()).st_size:
+                output.data = mmap.mmap(fileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                output.data = b""
+            problems = output.verify(self.edits.output_ranges(), self.edits.names)
+            output.close()
+        self.stats.chunks += output.stats.chunks
+        return problems
 
     def decode_date(self, timeString) -> datetime:
         "Processes the date string."
 
-        # 24hr: DD-MM-YYYY HH:mm
-        reEuro = re.compile(r"(\d\d).(\d\d).(\d\d\d\d)\s(\d\d).(\d\d)")
-        match = re.match(reEuro, timeString)
-        if match:
-            #logging.info("Euro String")
-            #logging.info(match.groups())
-            try:
-                day = int(match.group(1))
-                month = int(match.group(2))
-                year = int(match.group(3))
-                hour = int(match.group(4))
-                minute = int(match.group(5))
-                return datetime.datetime(
-                    year=year,
-                    month=month,
-                    day=day,
-                    hour=hour,
-                    minute=minute
-                )
-            except Exception as e:
-                logging.error(str(e))
-                logging.exception("Exception : ")
-
-        # 12hr: MM/DD/YYYY hh:mm XM *numbers are not 0-padded
-        reUS = re.compile(
-            r"(\d{1,2}).(\d{1,2}).(\d\d\d\d)\s(\d{1,2}).(\d{1,2}).*?(\w)M"
-            )
-        match = re.match(reUS, timeString)
-        if match:
-            #logging.info("US Date String")
-            #logging.info(match.groups())
-            try:
-                day = int(match.group(2))
-                month = int(match.group(1))
-                year = int(match.group(3))
-                hour = int(match.group(4))
-                minute = int(match.group(5))
-                meridiem = str(match.group(6))
-                if "p" in meridiem.lower():
-                    hour = hour + 12
-                return datetime.datetime(
-                    year=year,
-                    month=month,
-                    day=day,
-                    hour=hour,
-                    minute=minute
-                )
-            except Exception as e:
-                logging.error(str(e))
-                logging.exception("Exception : ")
-
-        # YYYY/MM/DD HH:MM
-        reAsian = re.compile(r"(\d\d\d\d).(\d\d).(\d\d)\s([^\u0000-\u007F]+)\s(\d?\d).(\d\d)")
-        # korean AM/PM 오후 means PM
-        match = re.match(
-            reAsian,
-            timeString
-        )
-        if match:
-            #logging.info("Asian Date String")
-            #logging.info(match.groups())
-            try:
-                day = int(match.group(3))
-                month = int(match.group(2))
-                year = int(match.group(1))
-                hour = int(match.group(5))
-                minute = int(match.group(6))
-                meridiem = match.group(4)
-                # korean pm
-                if meridiem == "오후":
-                     hour = hour + 12
-                date_time = datetime.datetime(
-                    year=year,
-                    month=month,
-                    day=day,
-                    hour=hour,
-                    minute=minute
-                )
-                return date_time
-            except Exception as e:
-                logging.error(str(e))
-                logging.exception("Exception : ")
+        return _decode_date(timeString)
 
     def __str__(self) -> str:
         output = "Data:\n"
@@ -674,6 +1552,591 @@ class ReplayAnonymizer:
         output += "playerList : {}\n".format(self.playerList)
         return output
 
+def manifest_path(inputPath) -> str:
+    "Returns the edit manifest sidecar path of a replay."
+
+    return inputPath + ".edits.json"
+
+
+def anonymize_file(inputPath, outputPath, nameTable=None, stream=False, stats=False,
+                   fixedWidth=False, inPlace=False, manifest=False, verify=False, scanWorkers=1):
+    "Anonymizes a single replay, returns (inputPath, success, message)."
+
+    manifestPath = manifest_path(inputPath) if manifest else None
+    try:
+        replay_anon = ReplayAnonymizer(
+            filePath=inputPath, memoryMap=stream or inPlace, lazy=True, scanWorkers=scanWorkers)
+        if not replay_anon.success:
+            replay_anon.close()
+            return inputPath, False, "Invalid replay file."
+        problems = []
+        if inPlace:
+            patched = replay_anon.patch_file(
+                filePath=outputPath, nameTable=nameTable, manifestPath=manifestPath)
+            replay_anon.close()
+            if not patched:
+                return inputPath, False, "Pseudonyms change the replay size."
+            if verify:
+                problems = replay_anon.verify_file(outputPath)
+        elif stream:
+            replay_anon.save_anonymized(
+                filePath=outputPath, nameTable=nameTable, fixedWidth=fixedWidth, manifestPath=manifestPath)
+            replay_anon.close()
+            if verify:
+                problems = replay_anon.verify_file(outputPath)
+        else:
+            replay_anon.replace_username(nameTable=nameTable, fixedWidth=fixedWidth, manifestPath=manifestPath)
+            if verify:
+                problems = replay_anon.verify()
+            replay_anon.save(filePath=outputPath)
+        report_stats(replay_anon, inputPath, stats)
+        if problems:
+            return inputPath, False, "Verification failed: " + "; ".join(problems)
+        return inputPath, True, outputPath
+    except Exception as e:
+        logging.error(str(e))
+        logging.exception("Stack Trace: ")
+        return inputPath, False, str(e)
+
+
+def anonymize_many(replays, nameTable=None, fixedWidth=False, verify=False):
+    "Anonymizes replays given as bytes, memoryviews or binary streams, yields an AnonymizedReplay for each."
+
+    # Nothing is printed or written to disk, one parser is reused for every
+    # replay. bytes are used as they are, other buffers are copied once so
+    # the caller's buffer is never modified.
+
+    replay = ReplayAnonymizer(console=False, lazy=True)
+    for source in replays:
+        try:
+            if hasattr(source, "read"):
+                source = source.read()
+            if not isinstance(source, bytes):
+                source = bytes(source)
+
+            replay.reset()
+            replay.data = source
+            if not replay.process_data():
+                yield AnonymizedReplay(None, {}, False, "Invalid replay file.")
+                continue
+
+            replay.replace_username(nameTable=nameTable, fixedWidth=fixedWidth)
+            problems = replay.verify() if verify else []
+
+            output = replay.data
+            replay.data = None
+            if problems:
+                yield AnonymizedReplay(
+                    output, dict(replay.edits.names), False, "Verification failed: " + "; ".join(problems))
+            else:
+                yield AnonymizedReplay(output, dict(replay.edits.names), True, "")
+        except Exception as e:
+            logging.error(str(e))
+            logging.exception("Stack Trace: ")
+            replay.data = None
+            yield AnonymizedReplay(None, {}, False, str(e))
+
+
+def read_player_names(inputPath) -> list:
+    "Returns the player names of a replay in DATAINFO order."
+
+    try:
+        replay = ReplayAnonymizer.read_metadata(inputPath)
+        return [player.name for player in replay.players]
+    except Exception as e:
+        logging.error(str(e))
+        logging.exception("Stack Trace: ")
+        return []
+
+
+# name table shared by every task of a batch worker process
+_workerNameTable = None
+
+
+def _initialize_worker(names):
+    global _workerNameTable
+    _workerNameTable = NameTable(names=names)
+
+
+def _anonymize_file_with_table(inputPath, outputPath, **options):
+    return anonymize_file(inputPath, outputPath, nameTable=_workerNameTable, **options)
+
+
+def find_replays(inputPath) -> list:
+    "Returns the replay files in a directory or matching a glob pattern."
+
+    if os.path.isdir(inputPath):
+        inputPath = os.path.join(inputPath, "*.rec")
+    return sorted(path for path in glob.glob(inputPath) if os.path.isfile(path))
+
+
+def report_stats(replay, inputPath, printStats=False):
+    "Logs the phase timings and counters of a replay as a JSON line."
+
+    output = replay.stats.json_line(filePath=inputPath)
+    logging.info(output)
+    if printStats:
+        print(output)
+
+
+def report_result(inputPath, success, message, note=""):
+    "Prints and logs the outcome of anonymizing one replay."
+
+    if success:
+        output = f"OK     '{inputPath}' ---> '{message}'"
+        if note:
+            output += " " + note
+        logging.info(output)
+    else:
+        output = f"FAILED '{inputPath}' : {message}"
+        logging.error(output)
+    print(output)
+
+
+def anonymize_batch(inputPath, outputDirectory, workers=None, nameTable=None, stream=False,
+                    cache=None, stats=False, fixedWidth=False, inPlace=False, manifest=False,
+                    verify=False) -> list:
+    "Anonymizes every replay in a directory or glob across a process pool."
+
+    replays = find_replays(inputPath)
+    os.makedirs(outputDirectory, exist_ok=True)
+
+    startTime = time.perf_counter()
+
+    results = []
+    # inputPath -> outputPath, a glob can match the same file name in several directories
+    outputPaths = {}
+    # real output path -> the replay written to it
+    claimed = {}
+    for replay in replays:
+        outputPath = os.path.join(outputDirectory, os.path.basename(replay))
+        realPath = os.path.normcase(os.path.realpath(outputPath))
+        if realPath in claimed:
+            message = f"'{outputPath}' is already the output of '{claimed[realPath]}'"
+        elif not inPlace and realPath == os.path.normcase(os.path.realpath(replay)):
+            message = "The output would replace the input, use --in-place."
+        else:
+            claimed[realPath] = replay
+            outputPaths[replay] = outputPath
+            continue
+        report_result(replay, False, message)
+        results.append((replay, False, message))
+    replays = list(outputPaths)
+
+    task = anonymize_file
+    initializer = None
+    initargs = ()
+    replayNames = {}
+    if nameTable is not None:
+        # assign every pseudonym up front, in replay order, so the
+        # workers all share one complete read-only table
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for replay, names in zip(replays, executor.map(read_player_names, replays)):
+                replayNames[replay] = {name: nameTable.pseudonym(name) for name in names}
+        task = _anonymize_file_with_table
+        initializer = _initialize_worker
+        initargs = (nameTable.names,)
+
+    cacheKeys = {}
+    if cache is not None:
+        # hash the inputs in parallel, look them up and store them here
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            cacheKeys = dict(zip(replays, executor.map(
+                partial(cache.key, fixedWidth=fixedWidth or inPlace),
+                replays,
+                [replayNames.get(replay) for replay in replays])))
+        misses = []
+        for replay in replays:
+            outputPath = outputPaths[replay]
+            if cache.fetch(cacheKeys[replay], outputPath):
+                report_result(replay, True, outputPath, note="(cached)")
+                results.append((replay, True, outputPath))
+            else:
+                misses.append(replay)
+        replays = misses
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        futures = [
+            executor.submit(
+                task,
+                replay,
+                outputPaths[replay],
+                stream=stream,
+                stats=stats,
+                fixedWidth=fixedWidth,
+                inPlace=inPlace,
+                manifest=manifest,
+                verify=verify)
+            for replay in replays
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            inputPath, success, message = future.result()
+            if success and cache is not None:
+                cache.store(cacheKeys[inputPath], message)
+            report_result(inputPath, success, message)
+            results.append((inputPath, success, message))
+
+    if cache is not None:
+        cache.evict()
+        output = cache.report()
+        print(output)
+        logging.info(output)
+
+    failed = sum(1 for _, success, _ in results if not success)
+    output = "Anonymized {} of {} replays in {:.2f}s, {} failed.".format(
+        len(results) - failed, len(results), time.perf_counter() - startTime, failed)
+    print(output)
+    logging.info(output)
+    return results
+
+
+# column name, Parquet type name, ReplayMeta value
+METADATA_COLUMNS = [
+    ("filePath", "string", lambda meta: meta.filePath),
+    ("fileVersion", "uint32", lambda meta: meta.fileVersion),
+    ("localDate", "timestamp", lambda meta: meta.localDate),
+    ("replayName", "string", lambda meta: meta.replayName),
+    ("gameVersion", "string", lambda meta: meta.gameVersion),
+    ("modName", "string", lambda meta: meta.modName),
+    ("mapName", "string", lambda meta: meta.mapName),
+    ("mapFileName", "string", lambda meta: meta.mapFileName),
+    ("mapWidth", "uint32", lambda meta: meta.mapWidth),
+    ("mapHeight", "uint32", lambda meta: meta.mapHeight),
+    ("matchType", "string", lambda meta: meta.matchType),
+    ("VPCount", "uint32", lambda meta: meta.VPCount),
+    ("randomStart", "bool", lambda meta: meta.randomStart),
+    ("highResources", "bool", lambda meta: meta.highResources),
+    ("playerCount", "uint8", lambda meta: len(meta.players)),
+    ("playerFaction", "list<string>", lambda meta: [player.faction for player in meta.players]),
+    ("playerTeam", "list<uint8>", lambda meta: [player.team for player in meta.players]),
+    ("playerComputer", "list<uint8>", lambda meta: [player.computer for player in meta.players]),
+]
+
+
+def _read_metadata(inputPath):
+    try:
+        meta = ReplayAnonymizer.read_metadata(inputPath)
+        return meta if meta.success else None
+    except Exception as e:
+        logging.error(str(e))
+        logging.exception("Stack Trace: ")
+        return None
+
+
+def export_metadata(inputPath, outputPath, workers=None) -> int:
+    "Parses the metadata of many replays in parallel and writes it as typed columns."
+
+    parquet = outputPath.endswith(".parquet")
+    if parquet and pyarrow is None:
+        raise ImportError("pyarrow is required to export metadata as Parquet, use a .json output instead")
+
+    replays = find_replays(inputPath)
+    columns = {name: [] for name, _, _ in METADATA_COLUMNS}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for meta in executor.map(_read_metadata, replays, chunksize=64):
+            if meta is None:
+                continue
+            for name, _, value in METADATA_COLUMNS:
+                columns[name].append(value(meta))
+    rows = len(columns["filePath"])
+
+    if parquet:
+        types = {
+            "string": pyarrow.string(),
+            "uint32": pyarrow.uint32(),
+            "uint8": pyarrow.uint8(),
+            "bool": pyarrow.bool_(),
+            "timestamp": pyarrow.timestamp('s'),
+            "list<string>": pyarrow.list_(pyarrow.string()),
+            "list<uint8>": pyarrow.list_(pyarrow.uint8()),
+        }
+        schema = pyarrow.schema([(name, types[typeName]) for name, typeName, _ in METADATA_COLUMNS])
+        table = pyarrow.Table.from_pydict(columns, schema=schema)
+        pyarrow.parquet.write_table(table, outputPath)
+    else:
+        # column oriented JSON, loads straight into a DataFrame
+        columns["localDate"] = [
+            date.isoformat() if date else None for date in columns["localDate"]]
+        with open(outputPath, "w", encoding="utf-8") as fileHandle:
+            json.dump({
+                "types": {name: typeName for name, typeName, _ in METADATA_COLUMNS},
+                "columns": columns,
+            }, fileHandle, ensure_ascii=False)
+
+    output = "Exported metadata of {} of {} replays to {}".format(rows, len(replays), outputPath)
+    print(output)
+    logging.info(output)
+    return rows
+
+
+# --search filter names, see ReplayIndex.search
+SEARCH_FILTERS = ("player", "team", "map", "mod", "matchType", "date")
+
+
+class ReplayIndex:
+    "SQLite search index of replay players, maps, mods, match types and dates."
+
+    def __init__(self, databasePath) -> None:
+
+        self.databasePath = databasePath
+        self.connection = sqlite3.connect(databasePath)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS replays (
+                id INTEGER PRIMARY KEY,
+                filePath TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                mapFileName TEXT,
+                mapName TEXT,
+                modName TEXT,
+                matchType TEXT,
+                localDate TEXT
+            );
+            CREATE TABLE IF NOT EXISTS players (
+                replayId INTEGER NOT NULL REFERENCES replays(id) ON DELETE CASCADE,
+                name TEXT NOT NULL,
+                team INTEGER,
+                faction TEXT,
+                computer INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS playersName ON players(name, team);
+            CREATE INDEX IF NOT EXISTS playersReplay ON players(replayId);
+            CREATE INDEX IF NOT EXISTS playersTeam ON players(team);
+            CREATE INDEX IF NOT EXISTS replaysMap ON replays(mapFileName);
+            CREATE INDEX IF NOT EXISTS replaysMod ON replays(modName);
+            CREATE INDEX IF NOT EXISTS replaysMatchType ON replays(matchType);
+            CREATE INDEX IF NOT EXISTS replaysDate ON replays(localDate);
+        """)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, inputPath, workers=None) -> tuple:
+        "Indexes new and changed replays in parallel, returns (indexed, removed, unchanged)."
+
+        indexed = {
+            filePath: (size, mtime)
+            for filePath, size, mtime in self.connection.execute(
+                "SELECT filePath, size, mtime FROM replays")
+        }
+        changed = []
+        signatures = {}
+        unchanged = 0
+        for replay in find_replays(inputPath):
+            replay = os.path.abspath(replay)
+            status = os.stat(replay)
+            signatures[replay] = (status.st_size, status.st_mtime_ns)
+            if indexed.get(replay) == signatures[replay]:
+                unchanged += 1
+            else:
+                changed.append(replay)
+
+        removed = [
+            (filePath,) for filePath in indexed
+            if filePath not in signatures and not os.path.isfile(filePath)
+        ]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            metadata = list(executor.map(_read_metadata, changed, chunksize=64))
+
+        with self.connection:
+            self.connection.executemany("DELETE FROM replays WHERE filePath = ?", removed)
+            self.connection.executemany(
+                "DELETE FROM replays WHERE filePath = ?", [(replay,) for replay in changed])
+            for replay, meta in zip(changed, metadata):
+                size, mtime = signatures[replay]
+                if meta is None:
+                    # remembered so an invalid replay is not parsed again until it changes
+                    self.connection.execute(
+                        "INSERT INTO replays (filePath, size, mtime) VALUES (?, ?, ?)",
+                        (replay, size, mtime))
+                    continue
+                replayId = self.connection.execute(
+                    "INSERT INTO replays (filePath, size, mtime, mapFileName, mapName, modName, "
+                    "matchType, localDate) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (replay, size, mtime, meta.mapFileName, meta.mapName, meta.modName,
+                     meta.matchType, meta.localDate.isoformat() if meta.localDate else None)
+                ).lastrowid
+                self.connection.executemany(
+                    "INSERT INTO players (replayId, name, team, faction, computer) VALUES (?, ?, ?, ?, ?)",
+                    [(replayId, player.name, player.team, player.faction, player.computer)
+                     for player in meta.players])
+
+        output = "Indexed {} replays, removed {}, {} unchanged.".format(
+            len(changed), len(removed), unchanged)
+        print(output)
+        logging.info(output)
+        return len(changed), len(removed), unchanged
+
+    def search(self, player=None, team=None, mapFileName=None, modName=None, matchType=None,
+               date=None) -> list:
+        "Returns the replays matching every given filter, date matches a YYYY, YYYY-MM or YYYY-MM-DD prefix."
+
+        conditions = []
+        parameters = []
+        if player is not None:
+            condition = "id IN (SELECT replayId FROM players WHERE name = ?"
+            parameters.append(player)
+            if team is not None:
+                condition += " AND team = ?"
+                parameters.append(int(team))
+            conditions.append(condition + ")")
+        elif team is not None:
+            conditions.append("id IN (SELECT replayId FROM players WHERE team = ?)")
+            parameters.append(int(team))
+        for column, value in (
+                ("mapFileName", mapFileName), ("modName", modName), ("matchType", matchType)):
+            if value is not None:
+                conditions.append(column + " = ?")
+                parameters.append(value)
+        if date is not None:
+            # ISO dates sort as text so a prefix is a range
+            conditions.append("localDate >= ? AND localDate < ?")
+            parameters += [date, date + "\x7f"]
+
+        query = "SELECT filePath FROM replays"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return [filePath for filePath, in self.connection.execute(query + " ORDER BY filePath", parameters)]
+
+
+class ReplayWatcher:
+    "Anonymizes replays into outputDirectory as they land in inputDirectory."
+
+    def __init__(self, inputDirectory, outputDirectory, workers=None, nameTable=None,
+                 stream=False, stats=False, pollInterval=0.1, settleTime=0.5, queueSize=32,
+                 statusInterval=10.0) -> None:
+
+        self.inputDirectory = inputDirectory
+        self.outputDirectory = outputDirectory
+        self.workers = workers or os.cpu_count() or 1
+        self.nameTable = nameTable
+        self.stream = stream
+        # print the stats JSON line of every replay
+        self.stats = stats
+        self.pollInterval = pollInterval
+        self.settleTime = settleTime
+        self.queueSize = queueSize
+        self.statusInterval = statusInterval
+
+        # path -> (size, mtime) and the time it was last seen changing
+        self.pending = {}
+        # path -> (size, mtime) when it was queued
+        self.queued = {}
+
+        self.processed = 0
+        self.failed = 0
+        self.totalLatency = 0.0
+        self.queue = None
+
+    async def run(self):
+        "Watches the input directory until cancelled."
+
+        os.makedirs(self.outputDirectory, exist_ok=True)
+        self.queue = asyncio.Queue(maxsize=self.queueSize)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+            tasks = [asyncio.create_task(self.poll())]
+            tasks += [asyncio.create_task(self.consume(executor)) for _ in range(self.workers)]
+            if self.statusInterval:
+                tasks.append(asyncio.create_task(self.report_status()))
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                if self.nameTable is not None:
+                    self.nameTable.save()
+
+    def scan(self) -> dict:
+        "Returns (size, mtime) for every replay in the input directory."
+
+        replays = {}
+        with os.scandir(self.inputDirectory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".rec") and entry.is_file():
+                    status = entry.stat()
+                    replays[entry.path] = (status.st_size, status.st_mtime_ns)
+        return replays
+
+    async def poll(self):
+        "Queues replays once their size and mtime stop changing."
+
+        while True:
+            now = time.perf_counter()
+            replays = self.scan()
+            # forget replays that were deleted or renamed
+            for seen in (self.pending, self.queued):
+                for path in [path for path in seen if path not in replays]:
+                    del seen[path]
+            for path, signature in replays.items():
+                if self.queued.get(path) == signature:
+                    continue
+                previous = self.pending.get(path)
+                if previous is None or previous[0] != signature:
+                    # new or still being written
+                    self.pending[path] = (signature, now)
+                elif now - previous[1] >= self.settleTime:
+                    del self.pending[path]
+                    self.queued[path] = signature
+                    # waits here when the workers fall behind, latency
+                    # counts from the last change so it includes the settle time
+                    await self.queue.put((path, previous[1]))
+            await asyncio.sleep(self.pollInterval)
+
+    async def consume(self, executor):
+        "Anonymizes queued replays in the executor."
+
+        loop = asyncio.get_running_loop()
+        while True:
+            inputPath, changeTime = await self.queue.get()
+            try:
+                outputPath = os.path.join(self.outputDirectory, os.path.basename(inputPath))
+                nameTable = None
+                if self.nameTable is not None:
+                    # assign pseudonyms here so every worker shares one table
+                    meta = await loop.run_in_executor(executor, ReplayAnonymizer.read_metadata, inputPath)
+                    nameTable = NameTable(names={
+                        player.name: self.nameTable.pseudonym(player.name)
+                        for player in meta.players})
+                _, success, message = await loop.run_in_executor(
+                    executor, partial(anonymize_file, inputPath, outputPath,
+                                      nameTable=nameTable, stream=self.stream, stats=self.stats))
+            except Exception as e:
+                success, message = False, str(e)
+            finally:
+                self.queue.task_done()
+
+            latency = time.perf_counter() - changeTime
+            self.totalLatency += latency
+            if success:
+                self.processed += 1
+            else:
+                self.failed += 1
+            report_result(inputPath, success, message, note=f"in {latency * 1000:.0f}ms")
+
+    def status(self) -> dict:
+        "Returns the queue depth, counts and average latency."
+
+        handled = self.processed + self.failed
+        return {
+            'queueDepth': self.queue.qsize() if self.queue else 0,
+            'pending': len(self.pending),
+            'processed': self.processed,
+            'failed': self.failed,
+            'averageLatency': self.totalLatency / handled if handled else 0.0,
+        }
+
+    async def report_status(self):
+        while True:
+            await asyncio.sleep(self.statusInterval)
+            output = ("queue depth {queueDepth}, pending {pending}, processed {processed}, "
+                      "failed {failed}, average latency {averageLatency:.3f}s").format(**self.status())
+            print(output)
+            logging.info(output)
+
+
 if __name__ == "__main__":
 
     # Program Entry Starts here
@@ -689,16 +2152,161 @@ if __name__ == "__main__":
 
     logging.getLogger().setLevel(logging.INFO)
 
-    if len(sys.argv) == 3:
-
-        if os.path.isfile(sys.argv[1]) and sys.argv[2]:
-            replay_anon = ReplayAnonymizer(filePath=sys.argv[1])
-            replay_anon.replace_username()
-            replay_anon.save(filePath= sys.argv[2])
+    parser = argparse.ArgumentParser(
+        description="Changes the names in Company of Heroes replays to Player #.")
+    parser.add_argument(
+        "input",
+        help="replay file, or a directory or glob of replays for batch mode")
+    parser.add_argument(
+        "output", nargs="?",
+        help="output replay file, or the output directory in batch mode")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None,
+        help="number of worker processes in batch mode (default: cpu count)")
+    parser.add_argument(
+        "-n", "--names",
+        help="JSON name table giving each player the same pseudonym in every replay")
+    parser.add_argument(
+        "-s", "--stream", action="store_true",
+        help="memory map the input and stream the output instead of rebuilding it in memory")
+    parser.add_argument(
+        "-c", "--cache",
+        help="directory caching anonymized replays so unchanged inputs are not anonymized again")
+    parser.add_argument(
+        "--cache-size", type=float, default=1024,
+        help="cache size in MB, least recently used replays are removed first (default: 1024)")
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="print the time of each phase and the work counters of every replay as JSON lines")
+    parser.add_argument(
+        "--fixed-width", action="store_true",
+        help="pad or shorten pseudonyms to the length of each name so no sizes change")
+    parser.add_argument(
+        "--in-place", action="store_true",
+        help="copy the input to output, or use it when they are the same, and overwrite only the "
+             "name bytes, implies --fixed-width")
+    parser.add_argument(
+        "-m", "--manifest", action="store_true",
+        help="reuse the name offsets saved next to each input as <input>.edits.json, "
+             "scanning and saving them when missing or out of date")
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="check the chunk sizes and that no original names remain in each anonymized replay")
+    parser.add_argument(
+        "--scan-workers", type=int, default=1,
+        help="worker processes searching a large replay for names, for single replays (default: 1)")
+    parser.add_argument(
+        "--export", action="store_true",
+        help="write the metadata of the input replays to output as columns, .parquet or .json")
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="keep watching the input directory and anonymize replays as they are written")
+    parser.add_argument(
+        "--index", action="store_true",
+        help="add new and changed input replays to the SQLite search index given as output")
+    parser.add_argument(
+        "--search", action="append", metavar="FILTER=VALUE",
+        help="search the index given as input, filters are player, team, map, mod, matchType and date")
+    args = parser.parse_args()
+
+    if args.output is None and not args.search:
+        parser.error("the output argument is required")
+    if (args.output and not (args.in_place or args.search or args.index or args.export)
+            and os.path.isdir(args.input) and os.path.isdir(args.output)
+            and os.path.samefile(args.input, args.output)):
+        parser.error("the output directory is the input directory, use --in-place to overwrite the replays")
+
+    nameTable = NameTable(filePath=args.names) if args.names else None
+    cache = ResultCache(args.cache, maxBytes=int(args.cache_size * 1e6)) if args.cache else None
+
+    if args.search:
+        filters = {}
+        for search in args.search:
+            key, separator, value = search.partition("=")
+            if not separator or key not in SEARCH_FILTERS:
+                parser.error("unknown search filter '{}', use one of {}".format(
+                    search, ", ".join(SEARCH_FILTERS)))
+            filters[key] = value
+        if "team" in filters and not filters["team"].isdigit():
+            parser.error("team must be a team number, not '{}'".format(filters["team"]))
+        index = ReplayIndex(args.input)
+        for filePath in index.search(
+                player=filters.get("player"),
+                team=filters.get("team"),
+                mapFileName=filters.get("map"),
+                modName=filters.get("mod"),
+                matchType=filters.get("matchType"),
+                date=filters.get("date")):
+            print(filePath)
+        index.close()
+    elif args.index:
+        index = ReplayIndex(args.output)
+        index.update(args.input, workers=args.workers)
+        index.close()
+    elif args.export:
+        try:
+            export_metadata(args.input, args.output, workers=args.workers)
+        except ImportError as e:
+            print(e)
+    elif args.watch and os.path.isdir(args.input):
+        watcher = ReplayWatcher(
+            args.input, args.output, workers=args.workers, nameTable=nameTable, stream=args.stream,
+            stats=args.stats)
+        try:
+            asyncio.run(watcher.run())
+        except KeyboardInterrupt:
+            pass
+    elif os.path.isfile(args.input):
+        cacheKey = None
+        if cache is not None:
+            names = None
+            if nameTable is not None:
+                names = {name: nameTable.pseudonym(name) for name in read_player_names(args.input)}
+            cacheKey = cache.key(args.input, names=names, fixedWidth=args.fixed_width or args.in_place)
+        if cacheKey and cache.fetch(cacheKey, args.output):
+            report_result(args.input, True, args.output, note="(cached)")
         else:
-            print(
-                "please enter a valid replay filename as the first argument.\n"
-                "and an output filename eg: output.rec as the second argument.")
-            
+            manifestPath = manifest_path(args.input) if args.manifest else None
+            replay_anon = ReplayAnonymizer(
+                filePath=args.input, memoryMap=args.stream or args.in_place, lazy=True,
+                scanWorkers=args.scan_workers)
+            problems = []
+            if replay_anon.success and args.in_place:
+                replay_anon.success = replay_anon.patch_file(
+                    filePath=args.output, nameTable=nameTable, manifestPath=manifestPath)
+                replay_anon.close()
+                if replay_anon.success and args.verify:
+                    problems = replay_anon.verify_file(args.output)
+            elif replay_anon.success and args.stream:
+                replay_anon.save_anonymized(
+                    filePath=args.output, nameTable=nameTable, fixedWidth=args.fixed_width,
+                    manifestPath=manifestPath)
+                replay_anon.close()
+                if args.verify:
+                    problems = replay_anon.verify_file(args.output)
+            elif replay_anon.success:
+                replay_anon.replace_username(
+                    nameTable=nameTable, fixedWidth=args.fixed_width, manifestPath=manifestPath)
+                if args.verify:
+                    problems = replay_anon.verify()
+                replay_anon.save(filePath=args.output)
+            if replay_anon.success:
+                report_stats(replay_anon, args.input, args.stats)
+            if problems:
+                replay_anon.success = False
+                print("Verification failed: " + "; ".join(problems))
+            if replay_anon.success and cacheKey:
+                cache.store(cacheKey, args.output)
+                cache.evict()
+    elif os.path.isdir(args.input) or glob.has_magic(args.input):
+        anonymize_batch(
+            args.input, args.output, workers=args.workers, nameTable=nameTable, stream=args.stream,
+            cache=cache, stats=args.stats, fixedWidth=args.fixed_width, inPlace=args.in_place,
+            manifest=args.manifest, verify=args.verify)
     else:
-        print("Usage: replay_anonymizer.py input.rec output.rec")
+        print(
+            "please enter a valid replay filename as the first argument.\n"
+            "and an output filename eg: output.rec as the second argument.")
+
+    if nameTable is not None:
+        nameTable.save()
@@ -0,0 +1,310 @@
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import benchmark
+from benchmark import build_replay
+from replay_anonymizer import (
+    NameTable, ReplayAnonymizer, ReplayIndex, ReplayWatcher, ResultCache, _decode_date,
+    anonymize_batch, anonymize_many, export_metadata, fit_pseudonym, manifest_path)
+
+
+def random_replays(count=40, seed=0) -> list:
+    "Returns count random synthetic replays as pytest params, short and empty names included."
+
+    rng = random.Random(seed)
+    replays = []
+    for number in range(count):
+        options = {
+            'players': rng.randint(1, 16),
+            'nameLength': rng.randint(0, 20),
+            'chatMessages': rng.randint(0, 30),
+            'mentions': rng.randint(0, 10),
+            'size': rng.choice([0, 20000]),
+            'seed': number,
+        }
+        replays.append(pytest.param(build_replay(**options), id=str(options)))
+    return replays
+
+
+def header_fields(meta):
+    "Returns the metadata of a replay without its file path and player names, which anonymizing changes."
+    return meta._replace(
+        filePath=None, players=tuple(player._replace(name=None) for player in meta.players))
+
+
+def parse(data):
+    replay = ReplayAnonymizer(console=False)
+    replay.data = data
+    replay.process_data()
+    return replay
+
+
+def write_replay(path, data=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(build_replay() if data is None else data)
+    return str(path)
+
+
+@pytest.mark.parametrize("data", random_replays())
+def test_replace_username_parses_back(data):
+    replay = parse(data)
+    expected = header_fields(replay.metadata())
+
+    replay.replace_username()
+
+    assert header_fields(replay.metadata()) == expected
+    assert header_fields(parse(bytes(replay.data)).metadata()) == expected
+    assert replay.verify() == []
+
+
+@pytest.mark.parametrize("data", random_replays())
+def test_fixed_width_pseudonyms_are_unique(data):
+    replay = parse(data)
+    expected = header_fields(replay.metadata())
+
+    replay.replace_username(fixedWidth=True)
+
+    assert header_fields(replay.metadata()) == expected
+    pseudonyms = [name.strip() for name in replay.edits.names.values()]
+    assert len(set(pseudonyms)) == len(pseudonyms)
+    assert "" not in pseudonyms
+
+
+@pytest.mark.parametrize("data", random_replays(count=10))
+def test_manifest_reuse_matches_scan(data, tmp_path):
+    filePath = write_replay(tmp_path / "synthetic.rec", data)
+    manifestPath = manifest_path(filePath)
+
+    outputs = []
+    for manifest in [None, manifestPath, manifestPath]:
+        replay = ReplayAnonymizer(filePath=filePath, console=False)
+        expected = header_fields(replay.metadata())
+        replay.replace_username(nameTable=NameTable(), manifestPath=manifest)
+        assert header_fields(replay.metadata()) == expected
+        outputs.append(bytes(replay.data))
+
+    assert os.path.isfile(manifestPath)
+    assert outputs[1] == outputs[0]
+    assert outputs[2] == outputs[0]
+
+
+@pytest.mark.parametrize("data", random_replays(count=10))
+def test_saved_and_patched_files_parse_back(data, tmp_path):
+    filePath = write_replay(tmp_path / "synthetic.rec", data)
+    replay = parse(data)
+    expected = header_fields(replay.metadata())
+    replay.replace_username()
+
+    streamPath = str(tmp_path / "stream.rec")
+    streamed = ReplayAnonymizer(filePath=filePath, memoryMap=True, console=False)
+    streamed.save_anonymized(filePath=streamPath)
+    streamed.close()
+    assert open(streamPath, "rb").read() == bytes(replay.data)
+    assert header_fields(ReplayAnonymizer.read_metadata(streamPath)) == expected
+
+    patchPath = str(tmp_path / "patch.rec")
+    patched = ReplayAnonymizer(filePath=filePath, memoryMap=True, console=False)
+    # refused when a pseudonym cannot fit its name
+    if patched.patch_file(filePath=patchPath):
+        assert header_fields(ReplayAnonymizer.read_metadata(patchPath)) == expected
+    patched.close()
+
+
+def test_chat_record_with_an_edited_length_prefix(monkeypatch):
+    # the first name is the utf-16le length prefix of the second
+    names = ["\x0c\x00", "Gamer1xabcde"]
+    monkeypatch.setattr(benchmark, "player_names", lambda players, nameLength: names)
+    replay = parse(build_replay(players=2, chatMessages=3, mentions=0))
+
+    replay.replace_username()
+
+    assert names[1].encode('utf-16le') not in replay.data
+    assert replay.verify() == []
+
+
+@pytest.mark.parametrize("date, expected", [
+    ("23/10/2008 21:31", (2008, 10, 23, 21, 31)),
+    ("23-10-2008 21:31 GMT", (2008, 10, 23, 21, 31)),
+    ("10/23/2008 11:05 PM", (2008, 10, 23, 23, 5)),
+    ("10/23/2008 11:05:30 pm", (2008, 10, 23, 23, 5)),
+    ("10/23/2008 12:05 AM", (2008, 10, 23, 0, 5)),
+    ("10/23/2008 12:05 PM", (2008, 10, 23, 12, 5)),
+    ("2008-10-23 오전 12:05", (2008, 10, 23, 0, 5)),
+    ("2008-10-23 오후 12:05", (2008, 10, 23, 12, 5)),
+    ("2008-10-23 오후 1:05", (2008, 10, 23, 13, 5)),
+])
+def test_decode_date(date, expected):
+    decoded = _decode_date(date)
+    assert (decoded.year, decoded.month, decoded.day, decoded.hour, decoded.minute) == expected
+
+
+def test_fit_pseudonym():
+    assert fit_pseudonym("Player 12", 10) == "Player 12 "
+    assert fit_pseudonym("Player 12", 3) == "P12"
+    assert fit_pseudonym("Player 12", 2) == "12"
+    assert fit_pseudonym("Player 12", 1) is None
+    assert fit_pseudonym("Player 1", 0) is None
+
+
+def test_name_table_numbers_after_the_highest_pseudonym(tmp_path):
+    nameTable = NameTable(names={"Alice": "Player 2"})
+    assert nameTable.pseudonym("Bob") == "Player 3"
+    assert nameTable.pseudonym("Alice") == "Player 2"
+
+    tablePath = tmp_path / "names.json"
+    tablePath.write_text(json.dumps({"Alice": "Player 7", "Carl": "Caster"}), encoding="utf-8")
+    nameTable = NameTable(filePath=str(tablePath))
+    assert nameTable.pseudonym("Bob") == "Player 8"
+    nameTable.save()
+    assert json.loads(tablePath.read_text(encoding="utf-8"))["Bob"] == "Player 8"
+
+
+def test_result_cache(tmp_path):
+    inputPath = write_replay(tmp_path / "input.rec")
+    outputPath = str(tmp_path / "output.rec")
+    cache = ResultCache(str(tmp_path / "cache"), maxBytes=0)
+
+    key = cache.key(inputPath)
+    assert key == cache.key(inputPath)
+    assert key != cache.key(inputPath, fixedWidth=True)
+    assert not cache.fetch(key, outputPath)
+
+    shutil.copyfile(inputPath, outputPath)
+    cache.store(key, outputPath)
+    os.remove(outputPath)
+    assert cache.fetch(key, outputPath)
+    assert cache.hits == 1 and cache.misses == 1
+
+    cache.evict()
+    assert not os.path.exists(cache.path(key))
+
+
+def test_replay_index_search(tmp_path):
+    replays = tmp_path / "replays"
+    write_replay(replays / "eight.rec")
+    write_replay(replays / "one.rec", build_replay(players=1))
+    index = ReplayIndex(str(tmp_path / "index.sqlite"))
+
+    assert index.update(str(replays), workers=1) == (2, 0, 0)
+    assert index.update(str(replays), workers=1) == (0, 0, 2)
+
+    eight, one = str(replays / "eight.rec"), str(replays / "one.rec")
+    assert index.search(team=1) == [eight]
+    assert index.search(team=0) == [eight, one]
+    assert index.search(player="Gamer1xabcde", team=1) == [eight]
+    assert index.search(player="Gamer1xabcde", team=0) == []
+    assert index.search(mapFileName="data:maps/pvp/2p_angoville_farms", date="2008-10") == [eight, one]
+    assert index.search(date="2009") == []
+    index.close()
+
+
+@pytest.mark.parametrize("search", ["mapName=nothing", "team=one", "nothing"])
+def test_search_rejects_bad_filters(tmp_path, search):
+    ReplayIndex(str(tmp_path / "index.sqlite")).close()
+    result = subprocess.run(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "replay_anonymizer.py"), str(tmp_path / "index.sqlite"),
+         "--search", search],
+        cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 2
+    assert "error" in result.stderr
+
+
+def test_anonymize_many():
+    data = build_replay()
+    results = list(anonymize_many(
+        [data, bytearray(data), memoryview(data), io.BytesIO(data), b"not a replay"], verify=True))
+
+    assert [result.success for result in results] == [True, True, True, True, False]
+    assert len({bytes(result.data) for result in results[:4]}) == 1
+    assert results[0].names["Gamer0xabcde"] == "Player 1"
+    assert results[4].message
+
+
+def test_export_metadata(tmp_path):
+    replays = tmp_path / "replays"
+    write_replay(replays / "a.rec")
+    write_replay(replays / "b.rec", build_replay(players=3))
+    outputPath = str(tmp_path / "metadata.json")
+
+    assert export_metadata(str(replays), outputPath, workers=1) == 2
+
+    exported = json.loads(open(outputPath, encoding="utf-8").read())
+    assert exported["columns"]["playerCount"] == [8, 3]
+    assert exported["columns"]["localDate"] == ["2008-10-23T21:31:00"] * 2
+
+
+def test_anonymize_batch_with_cache(tmp_path):
+    replays = tmp_path / "replays"
+    write_replay(replays / "a.rec")
+    write_replay(replays / "b.rec", build_replay(players=3))
+    output = str(tmp_path / "output")
+    cache = ResultCache(str(tmp_path / "cache"))
+
+    results = anonymize_batch(str(replays), output, workers=1, cache=cache, verify=True)
+    assert all(success for _, success, _ in results)
+    assert cache.misses == 2
+
+    results = anonymize_batch(str(replays), output, workers=1, cache=cache)
+    assert all(success for _, success, _ in results)
+    assert cache.hits == 2
+    assert ReplayAnonymizer.read_metadata(os.path.join(output, "b.rec")).players[0].name == "Player 1"
+
+
+def test_anonymize_batch_refuses_clashing_outputs(tmp_path):
+    write_replay(tmp_path / "g" / "a" / "x.rec")
+    write_replay(tmp_path / "g" / "b" / "x.rec")
+    write_replay(tmp_path / "g" / "a" / "y.rec")
+
+    results = anonymize_batch(str(tmp_path / "g" / "*" / "*.rec"), str(tmp_path / "output"), workers=1)
+
+    failed = [inputPath for inputPath, success, _ in results if not success]
+    assert failed == [str(tmp_path / "g" / "b" / "x.rec")]
+    assert sorted(os.listdir(tmp_path / "output")) == ["x.rec", "y.rec"]
+
+
+def test_anonymize_batch_refuses_to_replace_its_input(tmp_path):
+    original = build_replay()
+    inputPath = write_replay(tmp_path / "replays" / "a.rec", original)
+
+    results = anonymize_batch(str(tmp_path / "replays"), str(tmp_path / "replays"), workers=1)
+    assert [success for _, success, _ in results] == [False]
+    assert open(inputPath, "rb").read() == original
+
+    results = anonymize_batch(str(tmp_path / "replays"), str(tmp_path / "replays"), workers=1, inPlace=True)
+    assert [success for _, success, _ in results] == [True]
+    assert open(inputPath, "rb").read() != original
+
+
+def test_replay_watcher(tmp_path):
+    inputDirectory = tmp_path / "playback"
+    outputDirectory = tmp_path / "output"
+    write_replay(inputDirectory / "a.rec")
+    watcher = ReplayWatcher(
+        str(inputDirectory), str(outputDirectory), workers=1, pollInterval=0.02, settleTime=0.1,
+        statusInterval=0)
+
+    async def watch():
+        task = asyncio.create_task(watcher.run())
+        for _ in range(200):
+            await asyncio.sleep(0.05)
+            if watcher.processed:
+                break
+        os.remove(inputDirectory / "a.rec")
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(watch())
+
+    assert watcher.processed == 1 and watcher.failed == 0
+    # the latency counts from the last change, so includes the settle time
+    assert watcher.status()['averageLatency'] >= 0.1
+    assert watcher.pending == {} and watcher.queued == {}
+    assert ReplayAnonymizer.read_metadata(str(outputDirectory / "a.rec")).players[0].name == "Player 1"